@@ -0,0 +1,40 @@
+'''
+Compares how long each preallocation strategy takes on the filesystem the
+target directory lives on.
+
+    python -m benchmarks.bench_allocation [size in MiB] [directory]
+'''
+
+import os
+import sys
+import shutil
+import tempfile
+
+from bittorrent.torrent import Torrent
+from bittorrent.storage import DiskStorage
+from benchmarks.common import report
+
+if __name__ == '__main__':
+    size = int(sys.argv[1]) * 2**20 if len(sys.argv) > 1 else 2**30
+    piece_length = 2**20
+    num_pieces = (size + piece_length - 1) // piece_length
+
+    torrent = Torrent({
+        'announce': 'http://localhost/announce',
+        'info': {
+            'name': 'allocation',
+            'piece length': piece_length,
+            'pieces': b'\x00' * 20 * num_pieces,
+            'length': size
+        }
+    })
+
+    for strategy in ('sparse', 'full', 'zero'):
+        directory = tempfile.mkdtemp(dir=sys.argv[2] if len(sys.argv) > 2 else None)
+
+        try:
+            storage = DiskStorage.from_torrent(torrent, directory, resume=False, allocation=strategy)
+            report(strategy, storage.allocation_time, size)
+            del storage
+        finally:
+            shutil.rmtree(directory)
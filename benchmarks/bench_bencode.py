@@ -0,0 +1,107 @@
+'''
+Compares the offset-indexed decoder against the old iterator-based one.
+
+    python -m benchmarks.bench_bencode [file.torrent ...]
+'''
+
+from __future__ import print_function
+
+import itertools
+
+from io import BytesIO
+
+from bittorrent import bencode
+from benchmarks.common import measure, report, torrent_inputs
+
+def legacy_decode(data):
+    '''
+    The character-at-a-time decoder `bencode.decode` used to be.
+    '''
+
+    iterator, lookahead = itertools.tee(iter(data))
+    state = {'next': next(lookahead, None)}
+
+    def advance():
+        state['next'] = next(lookahead, None)
+        return next(iterator)
+
+    def number():
+        result = ''
+
+        while state['next'].isdigit():
+            result += advance()
+
+        return result
+
+    def consume():
+        item = state['next']
+
+        if item == 'i':
+            advance()
+            negative = state['next'] == '-'
+
+            if negative:
+                advance()
+
+            result = int(number())
+            advance()
+
+            return -result if negative else result
+        elif item in ('l', 'd'):
+            advance()
+            result = []
+
+            while state['next'] != 'e':
+                result.append(consume())
+
+            advance()
+
+            return result if item == 'l' else dict(zip(result[::2], result[1::2]))
+        else:
+            length = int(number())
+            advance()
+            result = ''
+
+            for i in range(length):
+                result += advance()
+
+            return result
+
+    return consume()
+
+def legacy_encode(obj):
+    '''
+    The recursive `str.format` encoder `bencode.encode` used to be.
+    '''
+
+    if isinstance(obj, str):
+        return '{0}:{1}'.format(len(obj), obj)
+    elif isinstance(obj, int):
+        return 'i{0}e'.format(obj)
+    elif isinstance(obj, list):
+        return 'l{0}e'.format(''.join([legacy_encode(o) for o in obj]))
+    else:
+        items = sorted(obj.items())
+
+        return 'd{0}e'.format(''.join([legacy_encode(str(key)) + legacy_encode(value) for key, value in items]))
+
+if __name__ == '__main__':
+    for name, data in torrent_inputs():
+        legacy = measure(lambda: legacy_decode(data), repeat=1)
+        current = measure(lambda: bencode.decode(data))
+        streamed = measure(lambda: bencode.decode_file(BytesIO(data)))
+
+        report('{0} (legacy decode)'.format(name), legacy, len(data))
+        report('{0} (decode)'.format(name), current, len(data))
+        report('{0} (decode_file)'.format(name), streamed, len(data))
+        print('{0} decode speedup: {1:.1f}x'.format(name, legacy / current))
+
+        meta = bencode.decode(data)
+        legacy = measure(lambda: legacy_encode(meta))
+        current = measure(lambda: bencode.encode(meta))
+        streamed = measure(lambda: bencode.encode_to(meta, BytesIO()))
+
+        report('{0} (legacy encode)'.format(name), legacy, len(data))
+        report('{0} (encode)'.format(name), current, len(data))
+        report('{0} (encode_to)'.format(name), streamed, len(data))
+        print('{0} encode speedup: {1:.1f}x'.format(name, legacy / current))
@@ -0,0 +1,56 @@
+'''
+Compares the bytes-backed Bitfield codec against the old dict-based one.
+
+    python -m benchmarks.bench_bitfield [number of pieces]
+'''
+
+from __future__ import print_function
+
+import os
+import sys
+
+from bittorrent import utils
+from bittorrent.protocol.message import Bitfield
+from benchmarks.common import measure, report
+
+def legacy_pack(bitfield):
+    data = ''
+    bits = ['0'] * (max(bitfield.keys()) + 1)
+
+    for piece, state in bitfield.items():
+        bits[piece] = '1' if state else '0'
+
+    for chunk in utils.grouper(8, bits, fillvalue='0'):
+        data += chr(int(''.join(chunk), 2))
+
+    return data
+
+def legacy_unpack(data):
+    d = {}
+    index = 0
+
+    for char in data:
+        for bit in bin(ord(char))[2:]:
+            d[index] = bool(int(bit))
+            index += 1
+
+    return d
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    data = os.urandom(utils.ceil_div(count, 8))
+    bitfield = Bitfield(data, count)
+    ours = os.urandom(len(data))
+
+    legacy = legacy_unpack(data)
+    legacy_ours = legacy_unpack(ours)
+
+    report('legacy unpack', measure(lambda: legacy_unpack(data)))
+    report('legacy pack', measure(lambda: legacy_pack(legacy)))
+    report('legacy missing pieces', measure(lambda: [p for p in legacy if legacy[p] and not legacy_ours.get(p)]))
+
+    report('unpack', measure(lambda: Bitfield.unpack(data)))
+    report('pack', measure(lambda: bitfield.pack()))
+    report('has, every piece', measure(lambda: [bitfield.has(p) for p in range(count)]))
+    report('popcount', measure(bitfield.popcount))
+    report('missing pieces', measure(lambda: list(bitfield.difference(ours))))
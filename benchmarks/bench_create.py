@@ -0,0 +1,47 @@
+'''
+Measures piece hashing throughput of `bittorrent.create` with a growing
+number of workers.
+
+    python -m benchmarks.bench_create [size in MiB]
+'''
+
+from __future__ import print_function
+
+import os
+import sys
+import shutil
+import tempfile
+import multiprocessing
+
+from bittorrent.create import create
+from benchmarks.common import measure
+
+def make_files(directory, total_size, num_files=8):
+    file_size = total_size // num_files
+
+    for index in range(num_files):
+        with open(os.path.join(directory, 'file{0}.bin'.format(index)), 'wb') as handle:
+            for chunk in range(0, file_size, 2**22):
+                handle.write(os.urandom(min(2**22, file_size - chunk)))
+
+if __name__ == '__main__':
+    size = int(sys.argv[1]) * 2**20 if len(sys.argv) > 1 else 2**28
+    directory = tempfile.mkdtemp()
+
+    try:
+        make_files(directory, size)
+
+        # Warm the page cache so we measure hashing, not the disk
+        create(directory, 'http://localhost/announce')
+
+        for executor in ('thread', 'process'):
+            workers = 1
+
+            while workers <= multiprocessing.cpu_count():
+                seconds = measure(lambda: create(directory, 'http://localhost/announce', workers=workers, executor=executor))
+                speed = size / seconds / 2**30
+
+                print('{0:<8} {1:>3} workers {2:>8.3f} GB/s {3:>8.3f} GB/s per core'.format(executor, workers, speed, speed / workers))
+                workers *= 2
+    finally:
+        shutil.rmtree(directory)
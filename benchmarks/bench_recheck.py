@@ -0,0 +1,44 @@
+'''
+Compares a serial full recheck against rechecks on a pool of workers.
+
+    python -m benchmarks.bench_recheck [size in MiB]
+'''
+
+from __future__ import print_function
+
+import os
+import sys
+import shutil
+import tempfile
+import multiprocessing
+
+from bittorrent.storage import DiskStorage
+from benchmarks.common import measure, report
+from benchmarks.bench_storage import make_torrent
+
+if __name__ == '__main__':
+    size = int(sys.argv[1]) * 2**20 if len(sys.argv) > 1 else 2**28
+    data = os.urandom(size)
+    directory = tempfile.mkdtemp()
+
+    try:
+        torrent = make_torrent(data, 2**20)
+        storage = DiskStorage.from_torrent(torrent, directory)
+
+        for index in range(storage.num_blocks):
+            storage.write_piece(index, 0, data[2**20 * index:2**20 * (index + 1)])
+
+        serial = measure(lambda: [storage.verify_block(index, force=True) for index in range(storage.num_blocks)])
+        report('serial verify_block', serial, size)
+
+        for executor in ('thread', 'process'):
+            workers = 1
+
+            while workers <= multiprocessing.cpu_count():
+                storage.workers = workers
+                seconds = measure(lambda: storage.recheck(executor=executor))
+                report('recheck, {0} workers ({1})'.format(workers, executor), seconds, size)
+
+                workers *= 2
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,76 @@
+'''
+Measures how long it takes for a piece to be done once its last block
+arrives, compared to hashing the whole piece at that point.
+
+    python -m benchmarks.bench_storage [piece size in MiB]
+'''
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import random
+import shutil
+import hashlib
+import tempfile
+
+from bittorrent.torrent import Torrent
+from bittorrent.storage import DiskStorage
+from benchmarks.common import measure, report
+
+BLOCK_SIZE = 2**14
+
+def make_torrent(data, piece_length):
+    pieces = b''.join(hashlib.sha1(data[i:i + piece_length]).digest() for i in range(0, len(data), piece_length))
+
+    return Torrent({
+        'announce': 'http://localhost/announce',
+        'info': {
+            'name': 'benchmark',
+            'piece length': piece_length,
+            'pieces': pieces,
+            'length': len(data)
+        }
+    })
+
+def completion_latency(storage, data, index, piece_length, shuffle):
+    '''
+    Writes every block of a piece and returns how long the last write took.
+    '''
+
+    offsets = list(range(0, piece_length, BLOCK_SIZE))
+
+    if shuffle:
+        # Blocks arrive out of order, but the last one is never the first
+        random.shuffle(offsets)
+
+    base = index * piece_length
+
+    for offset in offsets[:-1]:
+        storage.write_piece(index, offset, data[base + offset:base + offset + BLOCK_SIZE])
+
+    offset = offsets[-1]
+    start = time.time()
+    assert storage.write_piece(index, offset, data[base + offset:base + offset + BLOCK_SIZE])
+
+    return time.time() - start
+
+if __name__ == '__main__':
+    piece_length = int(sys.argv[1]) * 2**20 if len(sys.argv) > 1 else 2**24
+    num_pieces = 4
+    data = os.urandom(piece_length * num_pieces)
+    directory = tempfile.mkdtemp()
+
+    try:
+        storage = DiskStorage.from_torrent(make_torrent(data, piece_length), directory)
+
+        in_order = max(completion_latency(storage, data, index, piece_length, False) for index in range(0, num_pieces, 2))
+        shuffled = max(completion_latency(storage, data, index, piece_length, True) for index in range(1, num_pieces, 2))
+        whole = measure(lambda: hashlib.sha1(data[:piece_length]).digest())
+
+        report('hash a whole {0} MiB piece'.format(piece_length // 2**20), whole)
+        report('last block, blocks in order', in_order)
+        report('last block, blocks shuffled', shuffled)
+    finally:
+        shutil.rmtree(directory)
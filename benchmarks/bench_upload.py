@@ -0,0 +1,106 @@
+'''
+Compares the CPU time it takes to upload blocks by reading them into
+Python against sending them with sendfile. A child process drains the
+socket, so only the sender's time is counted.
+
+    python -m benchmarks.bench_upload [size in MiB]
+'''
+
+from __future__ import print_function
+
+import os
+import sys
+import socket
+import shutil
+import tempfile
+import multiprocessing
+
+from tornado.ioloop import IOLoop
+from tornado.iostream import IOStream
+from tornado.gen import coroutine
+
+from bittorrent.storage import DiskStorage
+from bittorrent.protocol.message import Piece
+from bittorrent.p2p import writer as writer_module
+from bittorrent.p2p.writer import MessageWriter, transfer
+from benchmarks.bench_storage import make_torrent
+
+BLOCK_SIZE = 2**14
+
+def drain(sock, other):
+    # The forked copy of our end would keep the connection open
+    other.close()
+
+    while sock.recv(2**20):
+        pass
+
+def upload(storage, use_sendfile):
+    '''
+    Sends every block of `storage`. Returns the CPU seconds spent and the
+    number of bytes that went through sendfile.
+    '''
+
+    left, right = socket.socketpair()
+    receiver = multiprocessing.Process(target=drain, args=(right, left))
+    receiver.start()
+    right.close()
+
+    stream = IOStream(left)
+    writer = MessageWriter(stream)
+
+    @coroutine
+    def run():
+        for index in range(storage.num_blocks):
+            for begin in range(0, storage.block_length(index), BLOCK_SIZE):
+                length = min(BLOCK_SIZE, storage.block_length(index) - begin)
+
+                if use_sendfile:
+                    file, offset = storage.locate_piece(index, begin, length)
+
+                    if writer.hold():
+                        header = Piece.pack_header(index, begin, length)
+                        writer.finish_file(*transfer(left.fileno(), header, file, offset, length))
+                    else:
+                        writer.send(Piece(index, begin, storage.read_piece(index, begin, length)))
+                        writer.flush()
+                else:
+                    writer.send(Piece(index, begin, storage.read_piece(index, begin, length)))
+                    writer.flush()
+
+                # Wait for the socket instead of buffering everything
+                if stream.writing():
+                    yield stream.write(b'')
+
+    start = os.times()
+    IOLoop.current().run_sync(run)
+    end = os.times()
+
+    stream.close()
+    receiver.join()
+
+    return (end[0] - start[0]) + (end[1] - start[1]), writer.sendfile_bytes
+
+if __name__ == '__main__':
+    size = int(sys.argv[1]) * 2**20 if len(sys.argv) > 1 else 2**28
+    data = os.urandom(size)
+    directory = tempfile.mkdtemp()
+
+    try:
+        storage = DiskStorage.from_torrent(make_torrent(data, 2**20), directory)
+
+        for index in range(storage.num_blocks):
+            storage.write_piece(index, 0, data[2**20 * index:2**20 * (index + 1)])
+
+        storage.flush()
+        modes = [('read_piece + write', False)]
+
+        if writer_module.sendfile is not None:
+            modes.append(('sendfile', True))
+        else:
+            print('sendfile is not available, install pysendfile on Python 2')
+
+        for name, use_sendfile in modes:
+            seconds, sent = upload(storage, use_sendfile)
+            print('{0:<40} {1:>10.3f} CPU s/GB {2:>6.1f}% sendfile'.format(name, seconds * 2**30 / size, 100.0 * sent / size))
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,144 @@
+'''
+Measures how fast a connection's incoming data is turned into messages:
+three `read_bytes` calls per message against framing large reads. Then
+counts the send syscalls per MB of outgoing messages, written one by one
+or through a `MessageWriter`.
+
+    python -m benchmarks.bench_wire [MiB of Piece messages]
+'''
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import socket
+import struct
+
+from tornado.ioloop import IOLoop
+from tornado.iostream import IOStream
+from tornado.gen import coroutine, Task, Return
+
+from bittorrent.protocol.message import Messages, Piece, Have, Request
+from bittorrent.protocol.framing import Framer
+from bittorrent.p2p.writer import MessageWriter
+from benchmarks.common import report
+
+BLOCK_SIZE = 2**14
+READ_SIZE = 2**16
+
+def make_stream(size):
+    block = os.urandom(BLOCK_SIZE)
+    messages = []
+
+    for index in range(size // BLOCK_SIZE):
+        messages.append(Piece(index // 16, BLOCK_SIZE * (index % 16), block).pack())
+        messages.append(Have(index).pack())
+
+    return b''.join(messages), 2 * (size // BLOCK_SIZE)
+
+@coroutine
+def read_legacy(stream, count):
+    for i in range(count):
+        length = struct.unpack('!I', (yield Task(stream.read_bytes, 4)))[0]
+        id = ord((yield Task(stream.read_bytes, 1)))
+        Messages[id].unpack((yield Task(stream.read_bytes, length - 1)))
+
+@coroutine
+def read_framed(stream, count):
+    framer = Framer()
+
+    while count:
+        chunk = yield Task(stream.read_bytes, READ_SIZE, partial=True)
+
+        for id, body in framer.feed(chunk):
+            Messages[id].unpack(body)
+            count -= 1
+
+def transfer(data, count, reader):
+    '''
+    Returns how long it takes `reader` to get `count` messages out of `data`
+    sent over a local socket.
+    '''
+
+    io_loop = IOLoop.current()
+    left, right = socket.socketpair()
+    sender, receiver = IOStream(left), IOStream(right)
+
+    start = time.time()
+    sender.write(data)
+    io_loop.run_sync(lambda: reader(receiver, count))
+    seconds = time.time() - start
+
+    sender.close()
+    receiver.close()
+
+    return seconds
+
+class CountingIOStream(IOStream):
+    syscalls = 0
+
+    def write_to_fd(self, data):
+        self.syscalls += 1
+
+        return IOStream.write_to_fd(self, data)
+
+def outgoing(size):
+    '''
+    Yields the messages that go out in each IOLoop iteration of a peer that
+    downloads and uploads at once: Requests for all blocks of a piece at
+    a time, a Piece for every block it is asked for, and a Have for every
+    piece it completes.
+    '''
+
+    block = os.urandom(BLOCK_SIZE)
+
+    for piece in range(size // (16 * BLOCK_SIZE)):
+        yield [Request(piece, BLOCK_SIZE * index, BLOCK_SIZE) for index in range(16)]
+
+        for index in range(16):
+            yield [Piece(piece, BLOCK_SIZE * index, block)]
+
+        yield [Have(piece)]
+
+def send(messages, coalesce):
+    io_loop = IOLoop.current()
+    left, right = socket.socketpair()
+    sender, receiver = CountingIOStream(left), IOStream(right)
+    writer = MessageWriter(sender)
+    total = 0
+
+    @coroutine
+    def run():
+        received = receiver.read_until_close()
+
+        for tick in messages:
+            for message in tick:
+                if coalesce:
+                    writer.send(message)
+                else:
+                    sender.write(message.pack())
+
+            yield Task(io_loop.add_callback)
+
+        writer.flush()
+        yield Task(io_loop.add_callback)
+        sender.close()
+
+        raise Return(len((yield received)))
+
+    total = io_loop.run_sync(run)
+    receiver.close()
+
+    return sender.syscalls, total
+
+if __name__ == '__main__':
+    size = int(sys.argv[1]) * 2**20 if len(sys.argv) > 1 else 2**27
+    data, count = make_stream(size)
+
+    report('read_bytes per message part', min(transfer(data, count, read_legacy) for i in range(3)), size)
+    report('framer, {0} KiB reads'.format(READ_SIZE // 2**10), min(transfer(data, count, read_framed) for i in range(3)), size)
+
+    for name, coalesce in (('write per message', False), ('MessageWriter', True)):
+        syscalls, total = send(outgoing(size // 8), coalesce)
+        print('{0:<40} {1:>10.1f} syscalls/MB'.format(name, syscalls / (total / 2.0**20)))
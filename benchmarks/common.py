@@ -0,0 +1,64 @@
+from __future__ import print_function
+
+import os
+import sys
+import time
+
+from bittorrent import bencode
+
+def measure(function, repeat=3):
+    '''
+    Returns the best wall-clock time of `repeat` calls to `function`.
+    '''
+
+    best = float('inf')
+
+    for i in range(repeat):
+        start = time.time()
+        function()
+        best = min(best, time.time() - start)
+
+    return best
+
+def report(name, seconds, size=None):
+    if size is None:
+        print('{0:<40} {1:>10.4f}s'.format(name, seconds))
+    else:
+        print('{0:<40} {1:>10.4f}s {2:>10.1f} MB/s'.format(name, seconds, size / seconds / 2**20))
+
+def synthetic_meta(num_pieces=20000, num_files=1000, piece_length=2**18):
+    '''
+    Builds metadata that looks like a large multi-file torrent.
+    '''
+
+    total = num_pieces * piece_length
+    file_size = total // num_files
+    files = []
+
+    for index in range(num_files):
+        length = file_size if index != num_files - 1 else total - file_size * (num_files - 1)
+        files.append({'length': length, 'path': ['folder{0}'.format(index % 10), 'file{0}.bin'.format(index)]})
+
+    return {
+        'announce': 'http://tracker.example.com:6969/announce',
+        'info': {
+            'name': 'synthetic',
+            'piece length': piece_length,
+            'pieces': os.urandom(20 * num_pieces),
+            'files': files
+        }
+    }
+
+def torrent_inputs(paths=None):
+    '''
+    Yields `(name, data)` for the given .torrent files, or a synthetic one.
+    '''
+
+    paths = paths if paths is not None else sys.argv[1:]
+
+    if not paths:
+        yield 'synthetic', bencode.encode(synthetic_meta())
+
+    for path in paths:
+        with open(path, 'rb') as handle:
+            yield os.path.basename(path), handle.read()
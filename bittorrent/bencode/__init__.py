@@ -3,5 +3,6 @@ try:
 except NameError:
     string_type = str
 
-from .encode import encode
+from .encode import encode, encode_to
 from .decode import decode
+from .stream import StreamParser, StreamDecoder, decode_file
@@ -1,141 +1,129 @@
-import itertools
-import collections
-
-from . import string_type
-
-try:
-    range = xrange
-except NameError:
-    pass
-
-def decode(data):
+def decode(data, raw_keys=None):
     '''
     Bdecodes data into Python built-in types.
-    '''
-
-    return consume(LookaheadIterator(data))
 
-class LookaheadIterator(collections.Iterator):
-    '''
-    An iterator that lets you peek at the next item.
+    If `raw_keys` is given, the exact encoded bytes of those keys' values in
+    the top-level dictionary are returned as well: `(value, {key: bytes})`.
     '''
 
-    def __init__(self, iterator):
-        self.iterator, self.next_iterator = itertools.tee(iter(iterator))
+    data = to_bytes(data)
 
-        # Be one step ahead
-        self._advance()
+    if not data:
+        raise ValueError('Decoding empty data is undefined')
 
-    def _advance(self):
-        self.next_item = next(self.next_iterator, None)
+    if raw_keys is None:
+        value, index = consume(data, 0)
 
-    def __next__(self):
-        self._advance()
+        return value
 
-        return next(self.iterator)
+    raw = {}
 
-    # Python 2 compatibility
-    next = __next__
-
-def consume(stream):
-    item = stream.next_item
-
-    if item is None:
-        raise ValueError('Encoding empty data is undefined')
-    elif item == 'i':
-        return consume_int(stream)
-    elif item == 'l':
-        return consume_list(stream)
-    elif item == 'd':
-        return consume_dict(stream)
-    elif item is not None and item[0].isdigit():
-        return consume_str(stream)
+    if data[:1] == b'd':
+        value, index = consume_dict(data, 0, raw_keys, raw)
     else:
-        raise ValueError('Invalid bencode object type: ', item)
+        value, index = consume(data, 0)
 
-def consume_number(stream):
-    result = ''
+    return value, raw
 
-    while True:
-        chunk = stream.next_item
+def to_bytes(data):
+    '''
+    Turns any buffer into something that supports `find` and cheap slicing.
+    '''
 
-        if not chunk.isdigit():
-            return result
-        elif result.startswith('0'):
-            raise ValueError('Invalid number')
+    if isinstance(data, memoryview):
+        return data.tobytes()
+    elif isinstance(data, bytearray):
+        return bytes(data)
+    else:
+        return data
 
-        next(stream)
-        result += chunk
+def consume(data, index):
+    '''
+    Decodes the object starting at `index`. Returns the object and the index
+    right after it.
+    '''
 
-def consume_int(stream):
-    if next(stream) != 'i':
-        raise ValueError()
+    item = data[index:index + 1]
+
+    if item == b'i':
+        return consume_int(data, index)
+    elif item == b'l':
+        return consume_list(data, index)
+    elif item == b'd':
+        return consume_dict(data, index)
+    elif item.isdigit():
+        return consume_str(data, index)
+    elif not item:
+        raise ValueError('Unexpected end of data')
+    else:
+        raise ValueError('Invalid bencode object type: ', item)
 
-    negative = stream.next_item == '-'
+def parse_number(number, signed=False):
+    negative = signed and number[:1] == b'-'
+    digits = number[1:] if negative else number
 
-    if negative:
-        next(stream)
+    if not digits.isdigit():
+        raise ValueError('Invalid number')
+    elif len(digits) > 1 and digits[:1] == b'0':
+        raise ValueError('Invalid number')
+    elif negative and digits == b'0':
+        raise ValueError('Negative zero is not allowed')
 
-    result = int(consume_number(stream))
+    result = int(digits)
 
-    if negative:
-        result *= -1
+    return -result if negative else result
 
-        if result == 0:
-            raise ValueError('Negative zero is not allowed')
+def consume_int(data, index):
+    end = data.find(b'e', index + 1)
 
-    if next(stream) != 'e':
+    if end == -1:
         raise ValueError('Unterminated integer')
 
-    return result
+    return parse_number(data[index + 1:end], signed=True), end + 1
 
-def consume_str(stream):
-    length = int(consume_number(stream))
+def consume_str(data, index):
+    colon = data.find(b':', index)
 
-    if next(stream) != ':':
+    if colon == -1:
         raise ValueError('Malformed string')
 
-    result = ''
+    length = parse_number(data[index:colon])
+    start = colon + 1
+    end = start + length
 
-    for i in range(length):
-        try:
-            result += next(stream)
-        except StopIteration:
-            raise ValueError('Invalid string length')
+    if end > len(data):
+        raise ValueError('Invalid string length')
 
-    return result
-
-def consume_list(stream):
-    if next(stream) != 'l':
-        raise ValueError()
+    return data[start:end], end
 
+def consume_list(data, index):
     l = []
+    index += 1
 
-    while stream.next_item != 'e':
-        l.append(consume(stream))
-
-    if next(stream) != 'e':
-        raise ValueError('Unterminated list')
-
-    return l
+    while data[index:index + 1] != b'e':
+        item, index = consume(data, index)
+        l.append(item)
 
-def consume_dict(stream):
-    if next(stream) != 'd':
-        raise ValueError()
+    return l, index + 1
 
+def consume_dict(data, index, raw_keys=(), raw=None):
     d = {}
+    index += 1
 
-    while stream.next_item != 'e':
-        key = consume(stream)
+    while data[index:index + 1] != b'e':
+        if not data[index:index + 1].isdigit():
+            if index >= len(data):
+                raise ValueError('Unterminated dictionary')
 
-        if not isinstance(key, string_type):
             raise ValueError('Dictionary keys must be strings')
 
-        value = consume(stream)
+        key, index = consume_str(data, index)
+        start = index
+        value, index = consume(data, index)
 
-        d[key] = value
+        if key in raw_keys:
+            raw[key] = data[start:index]
 
-    if next(stream) != 'e':
-        raise ValueError('Unterminated dictionary')
+        d[key] = value
 
-    return d
+    return d, index + 1
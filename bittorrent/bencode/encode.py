@@ -1,22 +1,108 @@
+from operator import itemgetter
+
 from . import string_type
 
+try:
+    integer_types = (int, long)
+except NameError:
+    integer_types = (int,)
+
 def encode(obj):
     '''
     Bencodes the object. The object must be an instance of: str, int, list, or dict.
     '''
 
-    if isinstance(obj, string_type):
-        return '{0}:{1}'.format(len(obj), obj)
-    elif isinstance(obj, int):
-        return 'i{0}e'.format(obj)
-    elif isinstance(obj, list):
-        values = ''.join([encode(o) for o in obj])
+    buffer = bytearray()
+    encode_into(obj, buffer.extend)
+
+    return bytes(buffer)
+
+def encode_to(obj, handle):
+    '''
+    Bencodes the object straight into a file-like object, without building
+    the whole encoded string in memory.
+    '''
+
+    encode_into(obj, handle.write)
 
-        return 'l{0}e'.format(values)
-    elif isinstance(obj, dict):
-        items = sorted(obj.items())
-        values = ''.join([encode(str(key)) + encode(value) for key, value in items])
+def encode_into(obj, write):
+    '''
+    Bencodes the object, passing each encoded piece to `write`.
+    '''
+
+    encoder_for(obj)(obj, write)
+
+def encoder_for(obj):
+    try:
+        return encoders[type(obj)]
+    except KeyError:
+        pass
 
-        return 'd{0}e'.format(values)
+    # Subclasses of the supported types
+    for types, encoder in encoders_by_base:
+        if isinstance(obj, types):
+            return encoder
+
+    raise TypeError('Unsupported type: {0}. Must be one of: str, int, list, dict.'.format(type(obj)))
+
+def encode_bytes(obj, write):
+    # Small strings are cheaper to copy than to write separately
+    if len(obj) < 2**12:
+        write(b'%d:%s' % (len(obj), obj))
     else:
-        raise TypeError('Unsupported type: {0}. Must be one of: str, int, list, dict.'.format(type(obj)))
+        write(b'%d:' % len(obj))
+        write(obj)
+
+def encode_text(obj, write):
+    encode_bytes(obj.encode('utf-8'), write)
+
+def encode_int(obj, write):
+    write(b'i%de' % obj)
+
+def encode_list(obj, write):
+    write(b'l')
+
+    for item in obj:
+        (encoders.get(type(item)) or encoder_for(item))(item, write)
+
+    write(b'e')
+
+def encode_dict(obj, write):
+    items = []
+
+    for key, value in obj.items():
+        if not isinstance(key, bytes):
+            if not isinstance(key, string_type):
+                raise TypeError('Dictionary keys must be strings')
+
+            key = key.encode('utf-8')
+
+        items.append((key, value))
+
+    items.sort(key=itemgetter(0))
+    write(b'd')
+
+    for key, value in items:
+        encode_bytes(key, write)
+        (encoders.get(type(value)) or encoder_for(value))(value, write)
+
+    write(b'e')
+
+encoders_by_base = [
+    (bytes, encode_bytes),
+    (string_type, encode_text),
+    (integer_types, encode_int),
+    (list, encode_list),
+    (dict, encode_dict)
+]
+
+encoders = {
+    bytes: encode_bytes,
+    type(u''): encode_text,
+    bool: encode_int,
+    list: encode_list,
+    dict: encode_dict
+}
+
+for cls in integer_types:
+    encoders[cls] = encode_int
@@ -0,0 +1,246 @@
+from .decode import parse_number, to_bytes
+
+class StreamParser(object):
+    '''
+    Resumable bencode parser. Data is pushed in with `feed`, which returns the
+    events that became complete: `('int', value)`, `('str', value)`,
+    `('list', None)`, `('dict', None)` and `('end', None)`.
+
+    Only the unparsed tail is buffered, so memory use is bounded by the
+    largest single string rather than the whole document.
+    '''
+
+    def __init__(self, raw_keys=()):
+        self.buffer = b''
+        self.stack = []
+        self.finished = False
+
+        # Exact encoded values of these keys in the top-level dictionary are
+        # collected into `raw`
+        self.raw_keys = raw_keys
+        self.raw = {}
+        self.capture_key = None
+        self.capture = None
+
+        # Body of a string that is split across chunks
+        self.string_length = None
+        self.string_parts = []
+        self.string_received = 0
+
+    def feed(self, chunk):
+        events = []
+        chunk = to_bytes(chunk)
+
+        if self.finished:
+            return events
+
+        if self.string_length is not None:
+            self.string_parts.append(chunk)
+            self.string_received += len(chunk)
+
+            if self.string_received < self.string_length:
+                return events
+
+            data = b''.join(self.string_parts)
+            self.string_parts = []
+
+            value = data[:self.string_length]
+            self.string_done(events, value)
+            self.consumed(value)
+
+            data = data[self.string_length:]
+            self.string_length = None
+        else:
+            data = self.buffer + chunk
+
+        index = 0
+
+        while index < len(data) and not self.finished:
+            start = index
+            item = data[index:index + 1]
+
+            if self.capture_key is not None and self.capture is None:
+                self.capture = []
+
+            if item == b'e':
+                if not self.stack:
+                    raise ValueError('Unexpected end of container')
+                elif self.stack[-1][0] == b'd' and self.stack[-1][1] % 2:
+                    raise ValueError('Dictionary key has no value')
+
+                self.stack.pop()
+                self.emit(events, 'end', None)
+                index += 1
+                self.consumed(data[start:index])
+
+                continue
+
+            if self.stack and self.stack[-1][0] == b'd' and not self.stack[-1][1] % 2 and not item.isdigit():
+                raise ValueError('Dictionary keys must be strings')
+
+            if item == b'i':
+                end = data.find(b'e', index + 1)
+
+                if end == -1:
+                    break
+
+                value = parse_number(data[index + 1:end], signed=True)
+
+                self.value_started()
+                self.emit(events, 'int', value)
+                index = end + 1
+            elif item == b'l' or item == b'd':
+                self.value_started()
+                self.stack.append([item, 0])
+                self.emit(events, 'list' if item == b'l' else 'dict', None)
+                index += 1
+            elif item.isdigit():
+                colon = data.find(b':', index)
+
+                if colon == -1:
+                    break
+
+                length = parse_number(data[index:colon])
+                body = colon + 1
+
+                if body + length > len(data):
+                    self.consumed(data[start:body])
+
+                    self.string_length = length
+                    self.string_parts = [data[body:]]
+                    self.string_received = len(data) - body
+
+                    data = b''
+                    index = 0
+
+                    break
+
+                self.string_done(events, data[body:body + length])
+                index = body + length
+            else:
+                raise ValueError('Invalid bencode object type: ', item)
+
+            self.consumed(data[start:index])
+
+        self.buffer = data[index:]
+
+        return events
+
+    def value_started(self):
+        if self.stack:
+            self.stack[-1][1] += 1
+
+    def string_done(self, events, value):
+        self.value_started()
+
+        # A completed key of the top-level dictionary
+        if len(self.stack) == 1 and self.stack[0][0] == b'd' and self.stack[0][1] % 2:
+            if value in self.raw_keys:
+                self.capture_key = value
+
+        self.emit(events, 'str', value)
+
+    def consumed(self, data):
+        if self.capture is None:
+            return
+
+        self.capture.append(data)
+
+        # The captured value ends once we are back in the top-level dictionary
+        if len(self.stack) == 1 and not self.stack[0][1] % 2:
+            self.raw[self.capture_key] = b''.join(self.capture)
+            self.capture_key = None
+            self.capture = None
+
+    def emit(self, events, event, value):
+        events.append((event, value))
+
+        if not self.stack and event != 'list' and event != 'dict':
+            self.finished = True
+
+    def close(self):
+        if not self.finished:
+            raise ValueError('Incomplete bencoded data')
+
+class StreamDecoder(object):
+    '''
+    Builds Python built-in types out of a `StreamParser`'s events. `callback`
+    is called with the decoded object once it is complete.
+
+    The encoded values of `raw_keys` in the top-level dictionary end up in
+    `raw`, as with `decode`.
+    '''
+
+    def __init__(self, callback=None, raw_keys=()):
+        self.parser = StreamParser(raw_keys)
+        self.callback = callback
+
+        self.stack = []
+        self.result = None
+        self.done = False
+
+    def feed(self, chunk):
+        for event, value in self.parser.feed(chunk):
+            if event == 'list':
+                self.stack.append([[], None])
+            elif event == 'dict':
+                self.stack.append([{}, None])
+            elif event == 'end':
+                self.add(self.stack.pop()[0])
+            else:
+                self.add(value)
+
+    def add(self, value):
+        if not self.stack:
+            self.result = value
+            self.done = True
+
+            if self.callback is not None:
+                self.callback(value)
+        else:
+            frame = self.stack[-1]
+            container, key = frame
+
+            if isinstance(container, list):
+                container.append(value)
+            elif key is None:
+                frame[1] = value
+            else:
+                container[key] = value
+                frame[1] = None
+
+    @property
+    def raw(self):
+        return self.parser.raw
+
+    def close(self):
+        '''
+        Returns the decoded object, raising a `ValueError` if it is incomplete.
+        '''
+
+        self.parser.close()
+
+        return self.result
+
+def decode_file(handle, chunk_size=2**16, raw_keys=None):
+    '''
+    Bdecodes the contents of a file object without reading it all at once.
+    Takes `raw_keys` just like `decode`.
+    '''
+
+    decoder = StreamDecoder(raw_keys=raw_keys or ())
+
+    while not decoder.done:
+        chunk = handle.read(chunk_size)
+
+        if not chunk:
+            break
+
+        decoder.feed(chunk)
+
+    value = decoder.close()
+
+    if raw_keys is None:
+        return value
+    else:
+        return value, decoder.raw
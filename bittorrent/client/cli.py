@@ -9,7 +9,7 @@ from tornado.options import define, options, parse_command_line, print_help
 
 from bittorrent.p2p import Server
 from bittorrent.torrent import Torrent
-from bittorrent.storage import DiskStorage
+from bittorrent.storage import DiskStorage, MmapStorage, MemoryStorage, SKIP, NORMAL, HIGH
 
 from bittorrent.utils import peer_id, gen_debuggable
 
@@ -26,6 +26,57 @@ define(
     help='download directory'
 )
 
+define(
+    name='storage',
+    type=str,
+    default='disk',
+    help='storage backend: "disk", "mmap" or "memory"'
+)
+
+define(
+    name='allocation',
+    type=str,
+    default='sparse',
+    help='how to preallocate files: "sparse", "full" or "zero"'
+)
+
+define(
+    name='storage_workers',
+    type=int,
+    default=4,
+    help='number of threads doing disk I/O and hashing'
+)
+
+define(
+    name='skip',
+    type=int,
+    multiple=True,
+    default=[],
+    help='indexes of files not to download'
+)
+
+define(
+    name='prioritize',
+    type=int,
+    multiple=True,
+    default=[],
+    help='indexes of files to download first'
+)
+
+define(
+    name='max_open_files',
+    type=int,
+    default=256,
+    help='maximum number of files kept open at once'
+)
+
+define(
+    name='read_cache_size',
+    type=int,
+    default=2**26,
+    help='bytes of verified pieces cached in memory for seeding (0 uploads with sendfile instead)'
+)
+
 define(
     name='port',
     type=int,
@@ -40,6 +91,13 @@ define(
     help='maximum number of connected peers'
 )
 
+define(
+    name='max_requests',
+    type=int,
+    default=250,
+    help='maximum number of block requests outstanding to each peer'
+)
+
 define(
     name='scrape_trackers',
     type=bool,
@@ -58,6 +116,12 @@ define(
     help='manually connect to this peer\'s port'
 )
 
+storage_classes = {
+    'disk': DiskStorage,
+    'mmap': MmapStorage,
+    'memory': MemoryStorage
+}
+
 if __name__ == '__main__':
     parse_command_line()
     enable_pretty_logging()
@@ -72,13 +136,28 @@ if __name__ == '__main__':
 
 
     torrent = Torrent(options.torrent)
+    priorities = [NORMAL] * len(torrent.info.files)
+
+    for index in options.prioritize:
+        priorities[index] = HIGH
+
+    for index in options.skip:
+        priorities[index] = SKIP
 
     server = Server(
         torrent=torrent,
         download_path=options.path,
-        storage_class=DiskStorage,
+        storage_class=storage_classes[options.storage],
+        storage_options={
+            'allocation': options.allocation,
+            'max_open_files': options.max_open_files,
+            'priorities': priorities
+        },
+        storage_workers=options.storage_workers,
+        read_cache_size=options.read_cache_size,
         peer_id=peer_id(),
-        max_peers=options.max_peers
+        max_peers=options.max_peers,
+        max_requests=options.max_requests
     )
     server.listen(options.port)
     server.start()
@@ -86,4 +165,14 @@ if __name__ == '__main__':
     if options.peer_ip and options.peer_port:
         server.connect(Peer(options.peer_ip, options.peer_port))
 
-    IOLoop.instance().start()
+    try:
+        IOLoop.instance().start()
+    finally:
+        logging.info('Storage stats: %s', server.async_storage.stats())
+        logging.info('File handle stats: %s', server.storage.handles.stats())
+
+        if options.read_cache_size:
+            logging.info('Read cache stats: %s', server.storage.stats())
+
+        server.async_storage.close()
+        server.storage.close()
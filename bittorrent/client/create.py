@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+import sys
+import time
+import logging
+
+from tornado.log import enable_pretty_logging
+from tornado.options import define, options, parse_command_line, print_help
+
+from bittorrent.create import create
+
+define(
+    name='path',
+    type=str,
+    help='file or directory to make a torrent out of'
+)
+
+define(
+    name='announce',
+    type=str,
+    help='tracker announce URL'
+)
+
+define(
+    name='output',
+    type=str,
+    help='where to save the torrent file'
+)
+
+define(
+    name='piece_length',
+    type=int,
+    help='piece length in bytes (picked automatically by default)'
+)
+
+define(
+    name='comment',
+    type=str,
+    help='comment stored in the torrent'
+)
+
+define(
+    name='private',
+    type=bool,
+    default=False,
+    help='mark the torrent as private'
+)
+
+define(
+    name='workers',
+    type=int,
+    help='number of hashing workers (defaults to the number of CPUs)'
+)
+
+define(
+    name='executor',
+    type=str,
+    default='thread',
+    help='hash with a "thread" or "process" pool'
+)
+
+if __name__ == '__main__':
+    parse_command_line()
+    enable_pretty_logging()
+
+    if not options.path or not options.announce or not options.output:
+        logging.error('Required arguments <path>, <announce> and <output> not provided')
+
+        print
+        print_help()
+
+        sys.exit(1)
+
+    start = time.time()
+
+    torrent = create(
+        path=options.path,
+        announce=options.announce,
+        piece_length=options.piece_length,
+        comment=options.comment,
+        private=options.private,
+        workers=options.workers,
+        executor=options.executor
+    )
+    torrent.save(options.output)
+
+    logging.info('Hashed %d pieces in %.2fs', torrent.info.num_pieces, time.time() - start)
@@ -0,0 +1,122 @@
+import os
+import time
+
+from .torrent import Torrent
+from .hashing import hash_in_pool
+
+MIN_PIECE_LENGTH = 2**14
+MAX_PIECE_LENGTH = 2**24
+
+# Bytes handed to a hashing worker at once
+BATCH_SIZE = 2**26
+
+def choose_piece_length(size, target_pieces=1500):
+    '''
+    Picks the smallest power-of-two piece length that keeps the number of
+    pieces around `target_pieces`.
+    '''
+
+    piece_length = MIN_PIECE_LENGTH
+
+    while piece_length < MAX_PIECE_LENGTH and size > piece_length * target_pieces:
+        piece_length *= 2
+
+    return piece_length
+
+def collect_files(path):
+    '''
+    Returns `(filename, path components, size)` for every file under `path`,
+    in the order they appear in the torrent.
+    '''
+
+    if os.path.isfile(path):
+        return [(path, [], os.path.getsize(path))]
+
+    result = []
+
+    for directory, folders, filenames in os.walk(path):
+        folders.sort()
+
+        for filename in sorted(filenames):
+            full_path = os.path.join(directory, filename)
+            components = os.path.relpath(full_path, path).split(os.sep)
+
+            result.append((full_path, components, os.path.getsize(full_path)))
+
+    return result
+
+def batches(files, piece_length, batch_size=BATCH_SIZE):
+    '''
+    Splits the concatenated files into piece-aligned batches of segments.
+    '''
+
+    batch_size = max(1, batch_size // piece_length) * piece_length
+    batch = []
+    batch_filled = 0
+
+    for filename, components, size in files:
+        offset = 0
+
+        while offset < size:
+            length = min(size - offset, batch_size - batch_filled)
+            batch.append((filename, offset, length))
+
+            offset += length
+            batch_filled += length
+
+            if batch_filled == batch_size:
+                yield batch, piece_length
+                batch = []
+                batch_filled = 0
+
+    if batch:
+        yield batch, piece_length
+
+def hash_files(files, piece_length, workers=None, executor='thread'):
+    '''
+    Returns the concatenated piece hashes of `files`, hashing batches on a
+    pool of `workers` threads or processes.
+    '''
+
+    return b''.join(hash_in_pool(batches(files, piece_length), workers, executor))
+
+def create(path, announce, announce_list=None, piece_length=None, comment=None,
+           private=False, workers=None, executor='thread'):
+    '''
+    Creates a torrent out of a file or directory.
+    '''
+
+    path = os.path.normpath(path)
+    files = collect_files(path)
+    total_size = sum(size for filename, components, size in files)
+
+    if piece_length is None:
+        piece_length = choose_piece_length(total_size)
+
+    info = {
+        'name': os.path.basename(path),
+        'piece length': piece_length,
+        'pieces': hash_files(files, piece_length, workers, executor)
+    }
+
+    if os.path.isfile(path):
+        info['length'] = total_size
+    else:
+        info['files'] = [{'path': components, 'length': size} for filename, components, size in files]
+
+    if private:
+        info['private'] = 1
+
+    meta = {
+        'announce': announce,
+        'creation date': int(time.time()),
+        'info': info
+    }
+
+    if announce_list is not None:
+        meta['announce-list'] = announce_list
+
+    if comment is not None:
+        meta['comment'] = comment
+
+    return Torrent(meta)
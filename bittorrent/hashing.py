@@ -0,0 +1,78 @@
+import hashlib
+import multiprocessing
+
+from multiprocessing.pool import ThreadPool
+
+# Bytes read from disk at once
+READ_SIZE = 2**22
+
+def hash_segments(args):
+    '''
+    Hashes consecutive `(filename, offset, length)` segments as one stream
+    split into pieces. The stream has to start on a piece boundary.
+    '''
+
+    segments, piece_length = args
+
+    digests = []
+    piece = hashlib.sha1()
+    filled = 0
+
+    for filename, offset, length in segments:
+        with open(filename, 'rb') as handle:
+            handle.seek(offset)
+
+            while length:
+                data = handle.read(min(length, READ_SIZE))
+
+                if not data:
+                    raise IOError('File changed size while hashing: ' + filename)
+
+                length -= len(data)
+                view = memoryview(data)
+                position = 0
+
+                while position < len(data):
+                    size = min(piece_length - filled, len(data) - position)
+                    piece.update(view[position:position + size])
+
+                    filled += size
+                    position += size
+
+                    if filled == piece_length:
+                        digests.append(piece.digest())
+                        piece = hashlib.sha1()
+                        filled = 0
+
+    if filled:
+        digests.append(piece.digest())
+
+    return b''.join(digests)
+
+def hash_in_pool(batches, workers=None, executor='thread'):
+    '''
+    Runs `hash_segments` over `(segments, piece length)` batches on a pool of
+    `workers` threads or processes, yielding the results in order. Hashing
+    happens in the calling thread if there is only one worker.
+    '''
+
+    workers = workers or multiprocessing.cpu_count()
+
+    if workers == 1:
+        for batch in batches:
+            yield hash_segments(batch)
+
+        return
+
+    if executor == 'thread':
+        pool = ThreadPool(workers)
+    elif executor == 'process':
+        pool = multiprocessing.Pool(workers)
+    else:
+        raise ValueError('executor must be "thread" or "process"')
+
+    try:
+        for result in pool.imap(hash_segments, batches):
+            yield result
+    finally:
+        pool.terminate()
@@ -1,19 +1,36 @@
-import struct
+import os
 import random
 import logging
 
+from collections import deque
+
 from tornado.ioloop import IOLoop, PeriodicCallback
-from tornado.gen import coroutine, Task, Return
+from tornado.concurrent import is_future
+from tornado.gen import coroutine, Task
 
+from bittorrent import utils
 from bittorrent.utils import gen_debuggable
+from bittorrent.protocol.framing import Framer, max_message_length
+from bittorrent.protocol import fast
+from bittorrent.p2p.writer import MessageWriter, transfer
 from bittorrent.protocol.message import (Messages, KeepAlive, Choke,
                                          Unchoke, Interested, NotInterested,
                                          Have, Bitfield, Request,
-                                         Piece, Cancel, Port)
+                                         Piece, Cancel, Port, Suggest,
+                                         HaveAll, HaveNone, Reject,
+                                         AllowedFast)
 
 class Client(object):
     protocol = 'BitTorrent protocol'
 
+    # Bytes read from the socket at once
+    read_size = 2**16
+
+    # Size of a single block request
+    request_size = 2**14
+
+    fast_messages = frozenset([Suggest.id, HaveAll.id, HaveNone.id, Reject.id, AllowedFast.id])
+
     @gen_debuggable
     def __init__(self, stream, peer, server):
         self.stream = stream
@@ -22,15 +39,52 @@ class Client(object):
         self.peer = peer
         self.server = server
 
+        # Messages are coalesced and written once per IOLoop iteration
+        self.writer = MessageWriter(stream)
+
         self.am_choking = True
         self.peer_choking = True
 
         self.am_interested = False
         self.peer_interested = False
 
-        self.peer_blocks = {}
+        self.peer_blocks = Bitfield(count=server.storage.num_blocks)
         self.message_queue = []
 
+        # Fast Extension state: whether the peer supports it, the pieces we
+        # may request while choked and the ones it suggested
+        self.fast = False
+        self.allowed_fast = set()
+        self.suggested = set()
+
+        # Requests sent to the peer that it hasn't answered, requests for the
+        # pieces we picked that aren't sent yet, and how many of both are
+        # left for every piece being downloaded from this peer
+        self.requests = set()
+        self.request_queue = deque()
+        self.pieces_left = {}
+
+        # Requests of the peer whose data is still being read
+        self.uploads = set()
+
+        self.handlers = {
+            Choke.id: self.got_choke,
+            Unchoke.id: self.got_unchoke,
+            Interested.id: self.got_interested,
+            NotInterested.id: self.got_notinterested,
+            Have.id: self.got_have,
+            Bitfield.id: self.got_bitfield,
+            Request.id: self.got_request,
+            Piece.id: self.got_piece,
+            Cancel.id: self.got_cancel,
+            Port.id: self.got_port,
+            Suggest.id: self.got_suggest,
+            HaveAll.id: self.got_have_all,
+            HaveNone.id: self.got_have_none,
+            Reject.id: self.got_reject,
+            AllowedFast.id: self.got_allowed_fast
+        }
+
         self.keepalive_callback = PeriodicCallback(lambda: self.send_message(KeepAlive()), 30 * 1000)
         self.keepalive_callback.start()
 
@@ -42,39 +96,18 @@ class Client(object):
     def write(self, data):
         return Task(self.stream.write, data)
 
-    @coroutine
-    @gen_debuggable
-    def get_message(self):
-        bytes = yield self.read_bytes(4)
-        length = struct.unpack('!I', bytes)[0]
-
-        if length == 0:
-            raise Return((KeepAlive, KeepAlive()))
-
-        id = ord((yield self.read_bytes(1)))
-
-        if id not in Messages:
-            raise ValueError('Invalid message type')
-
-        data = yield self.read_bytes(length - 1)
-        result = (Messages[id], Messages[id].unpack(data))
-
-        raise Return(result)
-
-    @coroutine
     @gen_debuggable
     def send_message(self, message):
         logging.debug('Sending a %s', message.__class__.__name__)
-        yield Task(self.stream.write, message.pack())
-        logging.debug('Sent a %s', message.__class__.__name__)
+        self.writer.send(message)
 
     @coroutine
     @gen_debuggable
     def handshake(self):
         message = chr(len(self.protocol))
         message += self.protocol
-        message += '\0\0\0\0\0\0\0\0'
-        message += self.server.torrent.info_hash()
+        message += fast.reserved_bytes()
+        message += self.server.torrent.info.info_hash
         message += self.server.peer_id
 
         logging.debug('Sending a handshake')
@@ -95,9 +128,10 @@ class Client(object):
             raise ValueError('Invalid protocol name')
 
         reserved_bytes = yield self.read_bytes(8)
+        self.fast = fast.supports_fast(reserved_bytes)
         info_hash = yield self.read_bytes(20)
 
-        if info_hash != self.server.torrent.info_hash():
+        if info_hash != self.server.torrent.info.info_hash:
             raise ValueError('Wrong info hash', info_hash)
 
         peer_id = yield self.read_bytes(20)
@@ -116,61 +150,103 @@ class Client(object):
     @gen_debuggable
     def message_loop(self):
         logging.debug('Starting the message loop...')
-        bitfield = Bitfield(self.server.storage.to_bitfield())
 
-        if bitfield:
-            logging.debug('First message is a bitfield. Recording...')
-            self.send_message(bitfield)
+        # Nothing counts as verified before the storage has been checked
+        yield self.server.verify()
+        self.send_have_message()
 
-        while True:
-            message_type, message = yield self.get_message()
+        if self.fast:
+            self.send_allowed_fast()
+
+        framer = Framer(max_message_length(self.server.storage.num_blocks))
 
-            logging.debug('Client sent us a %s', message.__class__.__name__)
+        while True:
+            chunk = yield Task(self.stream.read_bytes, self.read_size, partial=True)
 
+            # The stream can't be made sense of past a bad length prefix
             try:
-                if isinstance(message, KeepAlive):
-                    self.got_keepalive(message)
-                elif isinstance(message, Choke):
-                    self.got_choke(message)
-                elif isinstance(message, Unchoke):
-                    self.got_unchoke(message)
-                elif isinstance(message, Interested):
-                    self.got_interested(message)
-                elif isinstance(message, NotInterested):
-                    self.got_notinterested(message)
-                elif isinstance(message, Have):
-                    self.got_have(message)
-                elif isinstance(message, Bitfield):
-                    self.got_bitfield(message)
-                elif isinstance(message, Request):
-                    self.got_request(message)
-                elif isinstance(message, Piece):
-                    self.got_piece(message)
-                    self.maybe_request_piece()
-                elif isinstance(message, Cancel):
-                    self.got_cancel(message)
-                elif isinstance(message, Port):
-                    self.got_port(message)
-                else:
-                    logging.error('Invalid message received %s', repr(message))
-            except Exception as e:
-                logging.exception(e)
-
-            continue
+                messages = framer.feed(chunk)
+            except ValueError as e:
+                logging.warning('Dropping %s: %s', self.peer, e)
+                self.stream.close()
 
-            if self.is_endgame:
-                if self.server.storage.verify():
-                    logging.info('We got the file!')
-                    IOLoop.instance().stop()
+                return
+
+            for id, body in messages:
+                try:
+                    self.dispatch(id, body)
+                except Exception as e:
+                    logging.exception(e)
+
+    def send_have_message(self):
+        storage = self.server.storage
+        num_verified = storage.blocks.num_verified
+
+        if self.fast and num_verified == storage.num_blocks:
+            self.send_message(HaveAll())
+        elif self.fast and not num_verified:
+            self.send_message(HaveNone())
+        elif num_verified:
+            logging.debug('First message is a bitfield. Recording...')
+            self.send_message(Bitfield(storage.to_bitfield()))
+
+    def send_allowed_fast(self):
+        storage = self.server.storage
+        pieces = fast.allowed_fast_set(self.peer.address, self.server.torrent.info.info_hash, storage.num_blocks)
+
+        for piece in pieces:
+            if storage.blocks[piece]:
+                self.send_message(AllowedFast(piece))
 
-                for piece in self.missing_pieces:
-                    for start in range(0, self.server.storage.block_size, 2**14):
-                        self.server.announce_message(Request(piece, start, 2**14))
+    def dispatch(self, id, body):
+        if id is None:
+            return self.got_keepalive(KeepAlive())
+
+        try:
+            message_type = Messages[id]
+        except KeyError:
+            raise ValueError('Invalid message type: {0}'.format(id))
+
+        message = message_type.unpack(body)
+        logging.debug('Client sent us a %s', message_type.__name__)
+
+        # Peers must not use the Fast Extension without announcing it
+        if id in self.fast_messages and not self.fast:
+            logging.warning('%s sent a %s without supporting the Fast Extension', self.peer, message_type.__name__)
+            self.stream.close()
+
+            return
+
+        result = self.handlers[id](message)
+
+        # Coroutine handlers fail after they return, so watch their futures
+        if is_future(result):
+            IOLoop.current().add_future(result, self.handler_done)
+
+    def handler_done(self, future):
+        try:
+            future.result()
+        except Exception as e:
+            logging.exception(e)
 
     def got_choke(self, message):
         self.peer_choking = True
 
+        while self.request_queue:
+            self.request_done(self.request_queue.popleft())
+
+        # Without the Fast Extension the peer silently drops our requests,
+        # otherwise it rejects the ones it won't serve
+        if not self.fast:
+            for request in self.requests:
+                self.request_done(request)
+
+            self.requests.clear()
+
+        self.maybe_request_piece()
+
     def got_unchoke(self, message):
+        self.peer_choking = False
         self.maybe_express_interest()
         self.maybe_request_piece()
 
@@ -180,21 +256,85 @@ class Client(object):
 
         self.stop_if_completed()
 
-        piece = random.choice(self.desired_pieces())
+        # Keep up to `max_requests` blocks in flight, so the transfer isn't
+        # limited by request round trips
+        while len(self.requests) < self.server.max_requests:
+            if not self.request_queue and not self.queue_piece():
+                break
+
+            request = self.request_queue.popleft()
+            self.requests.add(request)
+            self.send_message(Request(*request))
+
+    def queue_piece(self):
+        # Pieces we are already downloading from this peer are left out
+        desired = [p for p in self.desired_pieces() if p not in self.pieces_left]
+
+        # While choked, only the allowed fast pieces can be requested
+        if self.peer_choking:
+            desired = [p for p in desired if p in self.allowed_fast]
+
+        if not desired:
+            return False
+
+        # Pieces of high priority files go first, suggested ones among them
+        priorities = self.server.storage.block_priorities
+        highest = max(priorities[p] for p in desired)
+        candidates = [p for p in desired if priorities[p] == highest]
+        piece = random.choice([p for p in candidates if p in self.suggested] or candidates)
 
         if piece == self.server.storage.num_blocks - 1:
             size = self.server.storage.last_block_size
         else:
             size = self.server.storage.block_size
 
-        length = min(size, 2**14)
+        for start in range(0, size, self.request_size):
+            self.request_queue.append((piece, start, min(self.request_size, size - start)))
+
+        self.pieces_left[piece] = utils.ceil_div(size, self.request_size)
+
+        return True
+
+    def request_done(self, request, keep=False):
+        '''
+        Counts a request of a piece as done. Once none are left, the piece can
+        be picked again, unless `keep` says it is still being written.
+        '''
+
+        index = request[0]
+        self.pieces_left[index] -= 1
+
+        if not self.pieces_left[index] and not keep:
+            del self.pieces_left[index]
+
+    def answered(self, index, begin, length, keep=False):
+        '''
+        Forgets an outstanding request. Returns whether we had sent it.
+        '''
+
+        request = (index, begin, length)
 
-        for start in range(0, size, length):
-            self.send_message(Request(piece, start, length))
+        if request not in self.requests:
+            return False
 
-        if size % length != 0:
-            end = length * (size // length)
-            self.send_message(Request(piece, end, size - end))
+        self.requests.remove(request)
+        self.request_done(request, keep)
+
+        return True
+
+    def cancel_piece(self, index):
+        '''
+        Cancels the requests for a piece that was completed elsewhere.
+        '''
+
+        for request in [r for r in self.request_queue if r[0] == index]:
+            self.request_queue.remove(request)
+            self.request_done(request)
+
+        for request in [r for r in self.requests if r[0] == index]:
+            self.requests.remove(request)
+            self.request_done(request)
+            self.send_message(Cancel(*request))
 
     def stop_if_completed(self):
         if not self.desired_pieces() and self.server.storage.verify():
@@ -202,43 +342,168 @@ class Client(object):
             IOLoop.instance().stop()
 
     def got_bitfield(self, message):
-        truncated = {key: value for key, value in message.bitfield.items() if key < self.server.storage.num_blocks}
+        message.resize(self.server.storage.num_blocks)
 
-        self.peer_blocks = truncated
+        self.peer_blocks = message
         self.maybe_express_interest()
 
     def got_have(self, message):
-        self.peer_blocks[message.piece] = True
+        if message.piece < self.server.storage.num_blocks:
+            self.peer_blocks.add(message.piece)
+
         self.maybe_express_interest()
 
+    @coroutine
+    @gen_debuggable
     def got_piece(self, message):
         logging.debug('Piece info: %d, %d, %d', message.index, message.begin, len(message.block))
         #self.peer.add_data_sample(len(message.block))
-        self.server.storage.write_piece(message.index, message.begin, message.block)
 
-        if self.server.storage.verify_block(message.index):
-            logging.info('Got a complete block!')
-            logging.critical(self.server.storage)
+        # The piece isn't verified until its last block is written, so it
+        # stays in progress until then instead of being requested again
+        answered = self.answered(message.index, message.begin, len(message.block), keep=True)
+        last = answered and not self.pieces_left[message.index]
+
+        written = self.server.async_storage.write_piece(message.index, message.begin, message.block)
+        self.maybe_request_piece()
+
+        try:
+            completed = yield written
+        finally:
+            if last and not self.pieces_left.get(message.index):
+                self.pieces_left.pop(message.index, None)
+
+        if completed:
+            logging.info('Got piece %d (%.1f%% done)', message.index, self.server.storage.percentage())
 
             self.stop_if_completed()
             self.server.announce_message(Have(message.index))
 
+            for client in self.server.connected_peers:
+                if client is not self:
+                    client.cancel_piece(message.index)
+
+    @coroutine
+    @gen_debuggable
     def got_request(self, message):
-        if message.length > 2**15:
-            raise ValueError('Requested too much data')
+        storage = self.server.storage
+
+        try:
+            if message.length > 2**15:
+                raise ValueError('Requested too much data')
+
+            storage.check_read(message.index, message.begin, message.length)
+        except ValueError:
+            self.reject(message)
+            raise
+
+        if not storage.blocks[message.index]:
+            self.reject(message)
+            return
+
+        request = (message.index, message.begin, message.length)
 
-        data = self.server.storage.read_piece(message.index, message.begin, message.length)
-        self.send_message(Piece(message.index, message.begin, data))
+        # Verified blocks are sent one way or the other, never both: through
+        # the read cache if there is one, as it saves the disk reads of popular
+        # pieces, or else with sendfile, which saves copying them into Python.
+        # Either way, only storage threads touch the disk.
+        if not self.server.read_cache_size:
+            location = storage.locate_piece(*request)
+
+            if location is not None and self.writer.hold():
+                yield self.send_file(message, *location)
+                return
+
+        self.uploads.add(request)
+
+        try:
+            data = yield self.server.async_storage.read_piece(*request)
+        finally:
+            cancelled = request not in self.uploads
+            self.uploads.discard(request)
+
+        if not cancelled:
+            logging.debug('Sending a Piece')
+            self.writer.send(Piece(message.index, message.begin, data), key=request)
     
+    def reject(self, message):
+        # Only fast peers expect to hear about requests we won't serve
+        if self.fast:
+            self.send_message(Reject(message.index, message.begin, message.length))
+
+    @coroutine
+    def send_file(self, message, file, file_offset):
+        header = Piece.pack_header(message.index, message.begin, message.length)
+
+        # A copy of the socket, which can't be closed and reused under the
+        # storage thread
+        fileno = os.dup(self.stream.socket.fileno())
+
+        try:
+            result = yield self.server.async_storage.submit(message.index, transfer, fileno, header, file, file_offset, message.length)
+        except Exception:
+            # Part of the Piece may be out already, so the stream is unusable
+            self.stream.close()
+            raise
+        finally:
+            os.close(fileno)
+
+        self.writer.finish_file(*result)
+
     def got_interested(self, message):
         self.peer_interested = True
 
+    def got_notinterested(self, message):
+        self.peer_interested = False
+
+    def got_cancel(self, message):
+        request = (message.index, message.begin, message.length)
+
+        if request in self.uploads:
+            self.uploads.remove(request)
+        else:
+            self.writer.cancel(request)
+
+    def got_port(self, message):
+        pass
+
     def got_keepalive(self, message):
         pass
 
+    def got_suggest(self, message):
+        if message.piece < self.server.storage.num_blocks:
+            self.suggested.add(message.piece)
+
+    def got_have_all(self, message):
+        count = self.server.storage.num_blocks
+        self.peer_blocks = Bitfield(b'\xff' * utils.ceil_div(count, 8), count)
+        self.maybe_express_interest()
+
+    def got_have_none(self, message):
+        self.peer_blocks = Bitfield(count=self.server.storage.num_blocks)
+        self.maybe_express_interest()
+
+    def got_reject(self, message):
+        # The peer won't send this block, so try to get something else now
+        logging.debug('Peer rejected %d, %d, %d', message.index, message.begin, message.length)
+
+        if self.answered(message.index, message.begin, message.length):
+            self.maybe_request_piece()
+
+    def got_allowed_fast(self, message):
+        if message.piece >= self.server.storage.num_blocks:
+            return
+
+        self.allowed_fast.add(message.piece)
+        self.maybe_express_interest()
+
+        if self.peer_choking:
+            self.maybe_request_piece()
+
     @gen_debuggable
     def desired_pieces(self):
-        want = [p for p in self.peer_blocks if not self.server.storage.blocks[p]]
+        storage = self.server.storage
+        want = list(self.peer_blocks.intersection(storage.blocks.wanted).difference(storage.blocks.verified))
         logging.debug('I want %s', repr(want))
 
         return want
@@ -270,7 +535,9 @@ class Client(object):
     @property
     @gen_debuggable
     def missing_pieces(self):
-        return [i for i in range(self.server.storage.num_blocks) if not self.server.storage.blocks[i]]
+        storage = self.server.storage
+
+        return [i for i in range(storage.num_blocks) if storage.wanted[i] and not storage.blocks[i]]
 
     @property
     @gen_debuggable
@@ -4,7 +4,7 @@ import socket
 from bittorrent.peer import Peer
 from bittorrent.torrent import Torrent
 from bittorrent.tracker import TrackerFailure
-from bittorrent.storage import DiskStorage
+from bittorrent.storage import DiskStorage, AsyncStorage, ReadCache
 
 from tornado.concurrent import Future
 from tornado.iostream import IOStream
@@ -13,25 +13,50 @@ from tornado.gen import coroutine, Task, Return
 
 from bittorrent.utils import peer_id, gen_debuggable
 from bittorrent.p2p import Client
+from bittorrent.protocol.message import Have
 
 class Server(TCPServer):
     @gen_debuggable
-    def __init__(self, torrent, max_peers=50, download_path='downloads', peer_id=peer_id(), storage_class=DiskStorage):
+    def __init__(self, torrent, max_peers=50, download_path='downloads', peer_id=peer_id(), storage_class=DiskStorage, storage_options=None, storage_workers=4, read_cache_size=2**26, max_requests=250):
         TCPServer.__init__(self)
 
         self.peer_id = peer_id
         self.torrent = torrent
 
         self.max_peers = max_peers
+        self.max_requests = max_requests
         self.connected_peers = set()
         self.connecting_peers = set()
         self.unconnected_peers = set()
 
-        self.storage = storage_class.from_torrent(torrent, base_path=download_path)
+        self.storage = storage_class.from_torrent(torrent, base_path=download_path, **(storage_options or {}))
+
+        # Without a read cache, verified blocks are uploaded with sendfile
+        self.read_cache_size = read_cache_size
+
+        if read_cache_size:
+            self.storage = ReadCache(self.storage, read_cache_size)
+
+        self.async_storage = AsyncStorage(self.storage, workers=storage_workers)
+        self.verified = None
+
+    def verify(self):
+        '''
+        Checks the blocks in an unknown state once, on the storage pool.
+        Returns a Future shared by everyone waiting on it.
+        '''
+
+        if self.verified is None:
+            self.verified = self.async_storage.verify()
+
+        return self.verified
 
     @coroutine
     @gen_debuggable
     def start(self, num_processes=1):
+        # Peers can't be told what we have until it has been checked
+        self.verify()
+
         TCPServer.start(self, num_processes)
 
         self.connect_to_peers()
@@ -141,11 +166,25 @@ class Server(TCPServer):
         self.connecting_peers.remove(client)
         self.connected_peers.add(client)
 
+    @gen_debuggable
+    def set_file_priority(self, index, priority):
+        self.storage.set_priority(index, priority)
+
+        # Peers may have gained or lost everything we want from them
+        for client in self.connected_peers:
+            client.maybe_express_interest()
+
     @gen_debuggable
     def announce_message(self, message):
         for client in self.connected_peers:
-            if not client.peer_choking:
-                client.send_message(message)
+            if client.peer_choking:
+                continue
+
+            # Peers that have the piece already don't need to hear about it
+            if isinstance(message, Have) and client.peer_blocks.has(message.piece):
+                continue
+
+            client.send_message(message)
 
     @gen_debuggable
     def listen(self, port, address=""):
@@ -0,0 +1,193 @@
+import os
+import errno
+import logging
+
+from tornado.ioloop import IOLoop
+from tornado.iostream import StreamClosedError, SSLIOStream
+
+from bittorrent.utils import as_bytes
+
+try:
+    from os import sendfile
+except ImportError:
+    try:
+        # Python 2 needs the pysendfile package
+        from sendfile import sendfile
+    except ImportError:
+        sendfile = None
+
+class MessageWriter(object):
+    '''
+    Outbound message queue of a connection. Messages are packed into one
+    buffer that is written out once per IOLoop iteration, or as soon as it
+    holds `flush_size` bytes.
+    '''
+
+    def __init__(self, stream, flush_size=2**16, io_loop=None):
+        self.stream = stream
+        self.flush_size = flush_size
+        self.io_loop = io_loop or IOLoop.current()
+
+        self.parts = []
+        self.buffered = 0
+        self.scheduled = False
+
+        # Positions in `parts` of the messages that can still be cancelled
+        self.queued = {}
+
+        # Set while the rest of a file sent with `send_file` is being read
+        self.held = False
+
+        self.messages = 0
+        self.flushes = 0
+        self.bytes = 0
+        self.sendfile_bytes = 0
+
+    def send(self, message, key=None):
+        data = message.pack()
+
+        if key is not None:
+            self.queued[key] = len(self.parts)
+
+        self.parts.append(data)
+        self.buffered += len(data)
+        self.messages += 1
+
+        if self.buffered >= self.flush_size:
+            self.flush()
+        elif not self.scheduled:
+            self.scheduled = True
+            self.io_loop.add_callback(self.flush)
+
+    def flush(self):
+        self.scheduled = False
+
+        if not self.parts or self.held:
+            return
+
+        data = b''.join(self.parts)
+        self.parts = []
+        self.buffered = 0
+        self.queued.clear()
+
+        if self.stream.closed():
+            return
+
+        try:
+            self.stream.write(data)
+        except StreamClosedError:
+            logging.debug('Dropped %d bytes for a closed stream', len(data))
+            return
+
+        self.flushes += 1
+        self.bytes += len(data)
+
+    def cancel(self, key):
+        '''
+        Drops the message sent with `key` if it hasn't been written yet.
+        Returns whether it was.
+        '''
+
+        position = self.queued.pop(key, None)
+
+        if position is None:
+            return False
+
+        self.buffered -= len(self.parts[position])
+        self.messages -= 1
+        self.parts[position] = b''
+
+        return True
+
+    def hold(self):
+        '''
+        Writes out everything queued and holds back later messages, so a
+        Piece can be written straight to the socket by `transfer` on another
+        thread. That only works with sendfile, a plain TCP stream and nothing
+        else waiting to be written, so returns whether it could.
+        '''
+
+        if sendfile is None or isinstance(self.stream, SSLIOStream) or self.held:
+            return False
+
+        self.flush()
+
+        if self.stream.closed() or self.stream.writing():
+            return False
+
+        self.held = True
+
+        return True
+
+    def finish_file(self, written, sent, rest):
+        '''
+        Takes the result of `transfer`: writes the part of the Piece the
+        socket did not take, then everything that was held back.
+        '''
+
+        self.held = False
+        self.messages += 1
+        self.bytes += written + len(rest)
+        self.sendfile_bytes += sent
+
+        if rest and not self.stream.closed():
+            self.stream.write(rest)
+
+        self.flush()
+
+    def stats(self):
+        return {
+            'messages': self.messages,
+            'flushes': self.flushes,
+            'bytes': self.bytes,
+            'sendfile_bytes': self.sendfile_bytes
+        }
+
+def transfer(fileno, header, file, offset, length):
+    '''
+    Writes `header` and `length` bytes of `file` at `offset` to the
+    non-blocking socket `fileno` for as long as it takes them, the bytes of
+    the file going from the page cache to the socket with sendfile. This
+    can wait on the disk, so it belongs on a storage thread.
+
+    Returns how many bytes were written, how many of them by sendfile, and
+    the rest of the message, which has to be written next.
+    '''
+
+    written = 0
+    sent = 0
+
+    try:
+        written = os.write(fileno, header)
+    except (IOError, OSError) as e:
+        if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+            raise
+
+    # The body can only follow a complete header
+    if written == len(header):
+        handle = file.pool.acquire(file)
+        position = file.locate(offset, length)
+
+        try:
+            while sent < length:
+                try:
+                    count = sendfile(fileno, handle.fileno(), position + sent, length - sent)
+                except (IOError, OSError) as e:
+                    if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        break
+
+                    raise
+
+                if not count:
+                    break
+
+                sent += count
+        finally:
+            file.pool.release(handle)
+
+    rest = header[written:]
+
+    if sent < length:
+        rest += as_bytes(file.read(offset + sent, length - sent))
+
+    return written + sent, sent, rest
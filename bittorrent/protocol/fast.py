@@ -0,0 +1,45 @@
+import socket
+import struct
+import hashlib
+
+# Reserved handshake bit that announces the Fast Extension
+RESERVED_BYTE = 7
+RESERVED_BIT = 0x04
+
+def reserved_bytes():
+    reserved = bytearray(8)
+    reserved[RESERVED_BYTE] |= RESERVED_BIT
+
+    return bytes(reserved)
+
+def supports_fast(reserved):
+    return bool(bytearray(reserved)[RESERVED_BYTE] & RESERVED_BIT)
+
+def allowed_fast_set(address, info_hash, num_pieces, k=10):
+    '''
+    Returns the `k` pieces a peer at the IPv4 `address` may request while
+    choked, as the canonical algorithm of BEP 6 picks them.
+    '''
+
+    try:
+        ip = struct.unpack('!I', socket.inet_aton(address))[0]
+    except (socket.error, struct.error):
+        return []
+
+    k = min(k, num_pieces)
+    x = struct.pack('!I', ip & 0xFFFFFF00) + info_hash
+    pieces = []
+
+    while len(pieces) < k:
+        x = hashlib.sha1(x).digest()
+
+        for offset in range(0, 20, 4):
+            if len(pieces) == k:
+                break
+
+            index = struct.unpack('!I', x[offset:offset + 4])[0] % num_pieces
+
+            if index not in pieces:
+                pieces.append(index)
+
+    return pieces
@@ -0,0 +1,102 @@
+from struct import Struct
+
+from bittorrent.utils import ceil_div
+
+header_struct = Struct('!IB')
+length_struct = Struct('!I')
+
+def max_message_length(num_pieces):
+    '''
+    Longest valid message for a torrent of `num_pieces`: a Piece of a
+    generous block size, or the Bitfield, whichever is longer.
+    '''
+
+    return max(2**17, 1 + ceil_div(num_pieces, 8))
+
+class Framer(object):
+    '''
+    Splits the byte stream of a peer connection into messages. Data is fed
+    in large chunks and every complete message in a chunk comes out as
+    `(id, body)`, with `body` a memoryview into the chunk. Only a message
+    that straddles two chunks is copied. Keep-alives have an id of `None`.
+    '''
+
+    def __init__(self, max_length=2**17):
+        self.max_length = max_length
+
+        # Start of a message that continues in the next chunk
+        self.pending = bytearray()
+
+    def feed(self, chunk):
+        messages = []
+        index = 0
+
+        if self.pending:
+            index, data = self.take_pending(chunk)
+
+            if data is None:
+                return messages
+
+            self.parse(data, 0, len(data), messages)
+
+        index = self.parse(chunk, index, len(chunk), messages)
+        self.pending = bytearray(chunk[index:])
+
+        return messages
+
+    def take_pending(self, chunk):
+        '''
+        Moves bytes from the start of `chunk` into the pending message. Returns
+        how many it took and the message, once it is complete.
+        '''
+
+        index = max(0, length_struct.size - len(self.pending))
+        self.pending += chunk[:index]
+
+        if len(self.pending) < length_struct.size:
+            return len(chunk), None
+
+        needed = length_struct.size + self.check_length(self.pending, 0) - len(self.pending)
+        self.pending += chunk[index:index + needed]
+        index += needed
+
+        if index > len(chunk):
+            return len(chunk), None
+
+        data = bytes(self.pending)
+        self.pending = bytearray()
+
+        return index, data
+
+    def check_length(self, data, index):
+        length = length_struct.unpack_from(data, index)[0]
+
+        if length > self.max_length:
+            raise ValueError('Message is too long: {0} bytes'.format(length))
+
+        return length
+
+    def parse(self, data, index, end, messages):
+        '''
+        Appends every complete message of `data[index:end]` to `messages`.
+        Returns the index right after the last one.
+        '''
+
+        view = memoryview(data)
+
+        while end - index >= length_struct.size:
+            length = self.check_length(data, index)
+            body_end = index + length_struct.size + length
+
+            if body_end > end:
+                break
+
+            if length == 0:
+                messages.append((None, view[body_end:body_end]))
+            else:
+                id = header_struct.unpack_from(data, index)[1]
+                messages.append((id, view[index + header_struct.size:body_end]))
+
+            index = body_end
+
+        return index
@@ -1,3 +1,4 @@
+import struct
 import inspect
 
 from bittorrent.protocol.common import Message
@@ -17,7 +18,11 @@ class Message(object):
 
     @classmethod
     def unpack_body(cls, data):
-        return cls.body_struct.unpack(data)
+        # `data` can be a view into the receive buffer
+        if len(data) != cls.body_struct.size:
+            raise struct.error('{0} body must be {1} bytes long'.format(cls.__name__, cls.body_struct.size))
+
+        return cls.body_struct.unpack_from(data)
 
     def pack(self, with_header=True):
         body = self.pack_body()
@@ -46,7 +51,7 @@ class BodylessMessage(Message):
 
     @classmethod
     def unpack_body(cls, data):
-        assert data == ''
+        assert len(data) == 0
 
         return ()
 
@@ -85,38 +90,101 @@ class Have(Message):
     def pack_body(self):
         return self.body_struct.pack(self.piece)
 
+# Positions of the set bits in every byte, high bit first
+set_bits = [tuple(bit for bit in range(8) if byte & (0x80 >> bit)) for byte in range(256)]
+
 class Bitfield(Message):
+    '''
+    The pieces a peer has, kept as the raw bits sent over the wire: the high
+    bit of the first byte is piece 0. `count` trims or pads the bits to
+    that many pieces.
+    '''
+
     id = 5
 
-    def __init__(self, bitfield):
-        self.bitfield = bitfield
+    def __init__(self, data=b'', count=None):
+        self.bits = bytearray(data)
+        self.count = 8 * len(self.bits)
 
-    def pack_body(self):
-        data = ''
-        bits = ['0'] * (max(self.bitfield.keys()) + 1)
+        if count is not None:
+            self.resize(count)
+
+    @classmethod
+    def from_pieces(cls, pieces, count):
+        bitfield = cls(count=count)
+
+        for piece in pieces:
+            bitfield.add(piece)
+
+        return bitfield
 
-        for piece, state in self.bitfield.items():
-            bits[piece] = '1' if state else '0'
+    def resize(self, count):
+        size = utils.ceil_div(count, 8)
 
-        for chunk in utils.grouper(8, bits, fillvalue='0'):
-            data += chr(int(''.join(chunk), 2))
+        del self.bits[size:]
+        self.bits.extend(bytearray(size - len(self.bits)))
 
-        return data
+        # Spare bits at the end are always clear
+        if count % 8:
+            self.bits[-1] &= (0xff00 >> (count % 8)) & 0xff
+
+        self.count = count
+
+    def pack_body(self):
+        return bytes(self.bits)
 
     @classmethod
     def unpack_body(cls, data):
-        d = {}
-        index = 0
+        return (data,)
+
+    def has(self, piece):
+        byte = piece >> 3
+
+        return 0 <= piece and byte < len(self.bits) and bool(self.bits[byte] & (0x80 >> (piece & 7)))
+
+    __contains__ = has
+
+    def add(self, piece):
+        if not 0 <= piece < self.count:
+            raise IndexError('Piece index out of range')
 
-        for char in data:
-            for bit in bin(ord(char))[2:]:
-                d[index] = bool(int(bit))
-                index += 1
+        self.bits[piece >> 3] |= 0x80 >> (piece & 7)
 
-        return (d,)
+    def popcount(self):
+        return utils.popcount(self.bits)
+
+    def combine(self, other, operation):
+        other = other.bits if isinstance(other, Bitfield) else bytearray(other)
+        size = len(self.bits)
+
+        # Shorter operands are padded with zeros
+        value = operation(utils.bytes_to_int(self.bits), utils.bytes_to_int(other[:size] + bytearray(size - len(other))))
+        result = Bitfield(utils.int_to_bytes(value, size))
+        result.count = self.count
+
+        return result
+
+    def intersection(self, other):
+        return self.combine(other, lambda a, b: a & b)
+
+    def union(self, other):
+        return self.combine(other, lambda a, b: a | b)
+
+    def difference(self, other):
+        return self.combine(other, lambda a, b: a & ~b)
+
+    def __iter__(self):
+        for byte_index, byte in enumerate(self.bits):
+            if byte:
+                base = 8 * byte_index
+
+                for bit in set_bits[byte]:
+                    yield base + bit
 
     def __nonzero__(self):
-        return any(self.bitfield.values())
+        return self.bits.count(b'\x00') < len(self.bits)
+
+    __bool__ = __nonzero__
 
 class Request(Message):
     id = 6
@@ -140,17 +208,26 @@ class Piece(Message):
         self.block = block
 
     def pack_body(self):
-        return self.body_struct.pack(self.index, self.begin) + self.block
+        return self.body_struct.pack(self.index, self.begin) + utils.as_bytes(self.block)
+
+    @classmethod
+    def pack_header(cls, index, begin, length):
+        '''
+        Packs everything up to the block, which can then be sent on its own.
+        '''
+
+        return cls.header_struct.pack(cls.body_struct.size + length + 1, cls.id) + cls.body_struct.pack(index, begin)
 
     @classmethod
     def unpack_body(cls, data):
-        index, begin = cls.body_struct.unpack(data[:cls.body_struct.size])
+        index, begin = cls.body_struct.unpack_from(data)
 
+        # A view of the block is handed to storage as is
         return index, begin, data[cls.body_struct.size:]
 
 class Cancel(Message):
     id = 8
-    structure = '!III'
+    body_struct = Struct('!III')
 
     def __init__(self, index, begin, length):
         self.index = index
@@ -162,7 +239,7 @@ class Cancel(Message):
 
 class Port(Message):
     id = 9
-    structure = '!I'
+    body_struct = Struct('!H')
 
     def __init__(self, port):
         self.port = port
@@ -170,4 +247,44 @@ class Port(Message):
     def pack_body(self):
         return self.body_struct.pack(self.port)
 
+# Fast Extension (BEP 6)
+
+class Suggest(Message):
+    id = 13
+    body_struct = Struct('!I')
+
+    def __init__(self, piece):
+        self.piece = piece
+
+    def pack_body(self):
+        return self.body_struct.pack(self.piece)
+
+class HaveAll(BodylessMessage):
+    id = 14
+
+class HaveNone(BodylessMessage):
+    id = 15
+
+class Reject(Message):
+    id = 16
+    body_struct = Struct('!III')
+
+    def __init__(self, index, begin, length):
+        self.index = index
+        self.begin = begin
+        self.length = length
+
+    def pack_body(self):
+        return self.body_struct.pack(self.index, self.begin, self.length)
+
+class AllowedFast(Message):
+    id = 17
+    body_struct = Struct('!I')
+
+    def __init__(self, piece):
+        self.piece = piece
+
+    def pack_body(self):
+        return self.body_struct.pack(self.piece)
+
 Messages = {cls.id: cls for name, cls in locals().items() if inspect.isclass(cls) and issubclass(cls, Message)}
@@ -1 +1,5 @@
-from .disk import DiskStorage
+from .disk import DiskStorage, SKIP, NORMAL, HIGH
+from .mapped import MmapStorage
+from .memory import MemoryStorage
+from .threaded import AsyncStorage
+from .cache import ReadCache
@@ -0,0 +1,91 @@
+import threading
+
+from collections import OrderedDict
+
+class ReadCache(object):
+    '''
+    Piece-granular LRU read cache in front of a storage object. The first
+    request for a block of a verified piece reads the whole piece, so the
+    following blocks, and other peers asking for the same popular pieces,
+    are served from memory. Everything else is passed through.
+    '''
+
+    def __init__(self, storage, size=2**26):
+        self.storage = storage
+        self.size = size
+
+        self.pieces = OrderedDict()
+        self.cached = 0
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __getattr__(self, name):
+        return getattr(self.storage, name)
+
+    def read_piece(self, index, offset, length):
+        # Only verified pieces are final
+        if not self.storage.blocks[index]:
+            return self.storage.read_piece(index, offset, length)
+
+        with self.lock:
+            data = self.pieces.pop(index, None)
+
+            if data is not None:
+                self.hits += 1
+                self.pieces[index] = data
+
+        if data is None:
+            data = self.storage.read_block(index)
+            self.store(index, data)
+
+            with self.lock:
+                self.misses += 1
+
+        if offset + length > len(data):
+            raise ValueError('Cannot read past end of block')
+
+        return data[offset:offset + length]
+
+    def store(self, index, data):
+        if len(data) > self.size:
+            return
+
+        with self.lock:
+            if index in self.pieces:
+                return
+
+            self.pieces[index] = data
+            self.cached += len(data)
+
+            while self.cached > self.size:
+                evicted_index, evicted = self.pieces.popitem(last=False)
+                self.cached -= len(evicted)
+                self.evictions += 1
+
+    def invalidate(self, index):
+        with self.lock:
+            data = self.pieces.pop(index, None)
+
+            if data is not None:
+                self.cached -= len(data)
+
+    def write_piece(self, index, offset, data):
+        self.invalidate(index)
+
+        return self.storage.write_piece(index, offset, data)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'cached_pieces': len(self.pieces),
+                'cached_bytes': self.cached
+            }
+
+    def __str__(self):
+        return str(self.storage)
@@ -1,26 +1,276 @@
 import os
+import time
 import hashlib
 import logging
+import threading
 
-from bittorrent.utils import ceil_div, create_and_open, mkdirs
+from bisect import bisect_right
+from collections import OrderedDict
+
+from bittorrent.utils import ceil_div, create_and_open, check_allocation, mkdirs, as_bytes
+from bittorrent.hashing import hash_in_pool
+from bittorrent.storage import resume
+from bittorrent.storage.handles import HandlePool
+from bittorrent.storage.state import BlockState
+
+try:
+    from os import pread, pwrite
+except ImportError:
+    pread = pwrite = None
 
 class PiecedFile(object):
-    def __init__(self, handle, size, offset=None):
-        self.handle = handle
+    '''
+    A file of the torrent. Its handle is borrowed from the storage's
+    `HandlePool` for every operation.
+    '''
+
+    def __init__(self, path, size, offset=None):
+        self.path = path
         self.size = size
         self.offset = offset
+        self.pool = None
+        self.dirty = False
+
+        # Only needed when there is no positional I/O and we have to seek
+        self.lock = threading.Lock()
+
+    def read(self, offset, length):
+        handle = self.pool.acquire(self)
+
+        try:
+            if pread is not None:
+                data = pread(handle.fileno(), length, offset)
+
+                # Short reads are rare, but allowed
+                while len(data) < length:
+                    chunk = pread(handle.fileno(), length - len(data), offset + len(data))
+
+                    if not chunk:
+                        raise IOError('Unexpected end of file')
+
+                    data += chunk
+
+                return data
+
+            with self.lock:
+                handle.seek(offset)
+
+                return handle.read(length)
+        finally:
+            self.pool.release(handle)
+
+    def write(self, offset, data):
+        handle = self.pool.acquire(self, write=True)
+        self.dirty = True
+
+        try:
+            if pwrite is not None:
+                data = memoryview(data)
+
+                while data:
+                    written = pwrite(handle.fileno(), data, offset)
+                    data = data[written:]
+                    offset += written
+
+                return
+
+            with self.lock:
+                handle.seek(offset)
+                handle.write(data)
+
+                # Rechecks read the file through their own handles
+                handle.flush()
+        finally:
+            self.pool.release(handle)
+
+    def sync(self):
+        '''
+        Makes sure everything written so far is on the disk.
+        '''
+
+        if not self.dirty:
+            return
+
+        self.dirty = False
+        handle = self.pool.acquire(self, write=True)
+
+        try:
+            handle.flush()
+            os.fsync(handle.fileno())
+        finally:
+            self.pool.release(handle)
+
+    def locate(self, offset, length):
+        '''
+        Returns where in the file at `path` the range is stored.
+        '''
+
+        return offset
+
+class PartFile(PiecedFile):
+    '''
+    Stands in for a skipped file that does not exist yet. Only its bytes in
+    its first and last block, which it can share with wanted files, are
+    kept, back to back in a small partfile next to where the file would be.
+    '''
+
+    def __init__(self, path, size, block_size, offset):
+        PiecedFile.__init__(self, path + '.part', size)
+        self.real_path = path
+
+        # Bytes kept from the start, and the file offset where they resume
+        self.head = min(size, block_size - offset % block_size)
+        self.tail = max(self.head, (offset + size - 1) // block_size * block_size - offset)
+
+    @property
+    def part_size(self):
+        return self.head + self.size - self.tail
+
+    def locate(self, offset, length):
+        if offset >= self.tail:
+            return self.head + offset - self.tail
+        elif offset + length <= self.head or self.head == self.tail:
+            return offset
+        else:
+            raise ValueError('Skipped files only keep their first and last block')
+
+    def read(self, offset, length):
+        return PiecedFile.read(self, self.locate(offset, length), length)
+
+    def write(self, offset, data):
+        PiecedFile.write(self, self.locate(offset, len(data)), data)
+
+class PendingPiece(object):
+    '''
+    A piece whose blocks are still arriving. Received blocks are tracked in a
+    bitmap; the data lives in `buffer` until the piece is spilled to disk.
+    The contiguous prefix of received blocks is fed into `hash` as it grows.
+
+    Writes that only cover part of a block are remembered as byte ranges
+    until the whole block has arrived.
+    '''
+
+    block_size = 2**14
+
+    def __init__(self, length):
+        self.length = length
+        self.buffer = bytearray(length)
+
+        self.num_blocks = ceil_div(length, self.block_size)
+        self.received = 0
+        self.num_received = 0
+        self.partial = {}
+
+        self.hash = hashlib.sha1()
+        self.hashed = 0
+
+        # Held while the piece's data or hash is being worked on
+        self.lock = threading.Lock()
+
+    def mark(self, offset, length):
+        end = offset + length
+
+        for block in range(offset // self.block_size, ceil_div(end, self.block_size)):
+            if self.received & (1 << block):
+                continue
+
+            start = block * self.block_size
+            stop = min(start + self.block_size, self.length)
+
+            ranges = self.partial.pop(block, [])
+            ranges.append((max(offset, start), min(end, stop)))
+            ranges = merge_ranges(ranges)
+
+            # Only blocks that are fully covered count as received
+            if ranges == [(start, stop)]:
+                self.received |= 1 << block
+                self.num_received += 1
+            else:
+                self.partial[block] = ranges
+
+    def next_to_hash(self):
+        '''
+        Returns the length of the block right after the hashed prefix if it
+        has arrived, or 0.
+        '''
+
+        if self.hashed < self.length and self.received & (1 << (self.hashed // self.block_size)):
+            return min(self.block_size, self.length - self.hashed)
+        else:
+            return 0
+
+    def received_ranges(self):
+        '''
+        Yields `(offset, length)` for every run of received blocks and every
+        part of a block received so far.
+        '''
+
+        for ranges in self.partial.values():
+            for start, stop in ranges:
+                yield start, stop - start
+
+        block = 0
+
+        while block < self.num_blocks:
+            if not self.received & (1 << block):
+                block += 1
+                continue
+
+            start = block
+
+            while block < self.num_blocks and self.received & (1 << block):
+                block += 1
+
+            offset = start * self.block_size
+            yield offset, min(block * self.block_size, self.length) - offset
+
+    @property
+    def complete(self):
+        return self.num_received == self.num_blocks
+
+def merge_ranges(ranges):
+    '''
+    Merges overlapping and adjacent `(start, stop)` ranges.
+    '''
+
+    merged = []
+
+    for start, stop in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+
+    return merged
+
+# File priorities
+SKIP = 0
+NORMAL = 1
+HIGH = 2
 
 class DiskStorage(object):
-    def __init__(self, files, block_size, block_hashes):
+    # Bytes handed to a hashing worker at once during a recheck
+    recheck_batch_size = 2**26
+
+    def __init__(self, files, block_size, pieces, buffer_size=2**26, workers=None,
+                 resume_path=None, info_hash=None, resume_interval=60, max_open_files=256,
+                 priorities=None):
         self.files = []
         self.size = 0
 
+        # Files are opened on demand, and only a bounded number at a time
+        self.handles = HandlePool(max_open_files, read_only=self.file_complete)
+
         for file in files:
             file.offset = self.size
+            file.pool = self.handles
 
             self.size += file.size
             self.files.append(file)
 
+        # Cumulative file offsets, for finding the files a range spans
+        self.offsets = [file.offset for file in self.files]
+
         self.block_size = block_size
         self.num_blocks = ceil_div(self.size, block_size)
         self.last_block_size = self.size % self.block_size
@@ -28,58 +278,173 @@ class DiskStorage(object):
         if self.last_block_size == 0:
             self.last_block_size = self.block_size
 
-        self.block_hashes = block_hashes
-        self.blocks = [None] * self.num_blocks
+        # Concatenated 20-byte SHA1 hashes of every block
+        self.pieces = pieces
+        self.blocks = BlockState(self.num_blocks)
+
+        # Blocks take the highest priority of the files they span. Only the
+        # wanted ones, which are not skipped, get downloaded.
+        self.priorities = list(priorities or [NORMAL] * len(self.files))
+        self.update_priorities()
+        self.allocation = 'sparse'
+
+        # Blocks that are being downloaded are assembled in memory, up to
+        # `buffer_size` bytes. Past that, the oldest ones are spilled to disk.
+        self.pending = OrderedDict()
+        self.buffer_size = buffer_size
+        self.buffered = 0
+
+        # Number of hashing workers for rechecks, one per CPU by default
+        self.workers = workers
+
+        # Guards the bookkeeping shared between pieces: `pending`, `blocks`
+        # and `buffered`. Work on a single piece happens under its own lock.
+        self.lock = threading.RLock()
+        self.resume_lock = threading.Lock()
+
+        # Verified blocks are saved to `resume_path` every `resume_interval`
+        # seconds and on close, so restarts can skip rehashing
+        self.resume_path = resume_path
+        self.info_hash = info_hash
+        self.resume_interval = resume_interval
+        self.resume_saved = time.time()
+
+        if self.resume_path is not None:
+            self.load_resume()
 
     @classmethod
-    def from_torrent(cls, torrent, base_path=None):
+    def from_torrent(cls, torrent, base_path=None, resume=True, allocation='sparse', priorities=None, **kwargs):
         files = []
-        hashes = list(torrent.piece_hashes)
-        block_size = torrent.meta['info']['piece length']
+        info = torrent.info
+        start = time.time()
 
-        if 'length' in torrent.meta['info']:
-            path = torrent.meta['info']['name']
-            size = torrent.meta['info']['length']
+        # Fail before any file is created
+        check_allocation(allocation)
+        priorities = priorities or [NORMAL] * len(info.files)
+
+        for entry, priority in zip(info.files, priorities):
+            path = os.path.join(*entry.path)
 
             if base_path is not None:
-                mkdirs(base_path)
                 path = os.path.join(base_path, path)
 
-            handle = create_and_open(path, 'r+b', size=size)
+            mkdirs(os.path.dirname(path) or '.')
 
-            files.append(PiecedFile(handle, size))
-        else:
-            for info in torrent.meta['info']['files']:
-                folders = [torrent.meta['info']['name']] + info['path'][:-1]
+            # Skipped files are not allocated, unless they are already there
+            if priority == SKIP and entry.length and not os.path.exists(path):
+                file = PartFile(path, entry.length, info.piece_length, entry.offset)
 
-                if base_path is not None:
-                    folders = [base_path] + folders
+                if not os.path.exists(file.path):
+                    create_and_open(file.path, 'rb', size=file.part_size).close()
 
-                filename = info['path'][-1]
-                directory = os.path.join(*folders)
+                files.append(file)
+                continue
 
-                mkdirs(directory)
+            if not os.path.exists(path):
+                create_and_open(path, 'rb', size=entry.length, allocation=allocation).close()
 
-                size = info['length']
-                handle = create_and_open(os.path.join(directory, filename), 'r+b', size=size)
+            files.append(cls.open_file(path, entry.length))
 
-                files.append(PiecedFile(handle, size))
+        allocation_time = time.time() - start
+        logging.info('Allocated %d files (%s) in %.3fs', len(files), allocation, allocation_time)
 
-        return cls(files, block_size, hashes)
+        if resume:
+            kwargs['resume_path'] = os.path.join(base_path or '', info.name + '.resume')
+            kwargs['info_hash'] = info.info_hash
 
-    def get_file_by_offset(self, offset):
-        total_offset = 0
+        storage = cls(files, info.piece_length, info.pieces, priorities=priorities, **kwargs)
+        storage.allocation = allocation
+        storage.allocation_time = allocation_time
 
-        for file in self.files:
-            if total_offset <= offset < total_offset + file.size:
-                file.handle.seek(offset - total_offset)
-                return file
-            else:
-                total_offset += file.size
+        return storage
 
-        raise ValueError('Invalid offset')
+    @classmethod
+    def open_file(cls, path, size):
+        return PiecedFile(path, size)
+
+    def file_blocks(self, file):
+        '''
+        Returns the range of blocks that `file` is part of.
+        '''
+
+        if not file.size:
+            return range(0)
+
+        return range(file.offset // self.block_size, (file.offset + file.size - 1) // self.block_size + 1)
+
+    def file_complete(self, file):
+        '''
+        Whether every block that `file` is part of has been verified, so it
+        will only ever be read from.
+        '''
+
+        return all(self.blocks[index] for index in self.file_blocks(file))
+
+    def update_priorities(self):
+        self.block_priorities = [SKIP] * self.num_blocks
+
+        for file, priority in zip(self.files, self.priorities):
+            for index in self.file_blocks(file):
+                self.block_priorities[index] = max(self.block_priorities[index], priority)
+
+        self.wanted = [priority != SKIP for priority in self.block_priorities]
+        self.blocks.set_wanted(self.wanted)
+
+    def set_priority(self, index, priority):
+        '''
+        Changes the priority of the file at `index`. A skipped file that is
+        wanted again is allocated, keeping the blocks it shares with others.
+        '''
+
+        if priority not in (SKIP, NORMAL, HIGH):
+            raise ValueError('Invalid priority: {0}'.format(priority))
+
+        with self.lock:
+            part = self.files[index]
+
+            if priority != SKIP and isinstance(part, PartFile):
+                file = self.open_file(part.real_path, part.size)
+                file.offset = part.offset
+                file.pool = self.handles
+
+                with create_and_open(file.path, 'r+b', size=file.size, allocation=self.allocation) as handle:
+                    handle.write(part.read(0, part.head))
+                    handle.seek(part.tail)
+                    handle.write(part.read(part.tail, part.size - part.tail))
+
+                self.files[index] = file
+                self.handles.discard(part)
+                os.remove(part.path)
+
+            self.priorities[index] = priority
+            self.update_priorities()
+
+    def segments(self, position, length):
+        '''
+        Yields `(file, file offset, length)` for every file that the range of
+        `length` bytes starting at `position` spans.
+        '''
+
+        index = bisect_right(self.offsets, position) - 1
+
+        while length > 0:
+            file = self.files[index]
+            file_offset = position - file.offset
+            size = min(length, file.size - file_offset)
+
+            # Skip over empty files
+            if size > 0:
+                yield file, file_offset, size
+
+                position += size
+                length -= size
+
+            index += 1
+
+    def check_read(self, index, offset, length):
+        if not 0 <= index < self.num_blocks:
+            raise ValueError('Block index out of range')
 
-    def read_piece(self, index, offset, length):
         if offset >= self.block_size:
             raise ValueError('Offset must be smaller than the block size')
 
@@ -89,19 +454,33 @@ class DiskStorage(object):
         if index == self.num_blocks - 1 and offset + length > self.last_block_size:
             raise ValueError('Cannot read past end of last block')
 
-        data = ''
+    def read_piece(self, index, offset, length):
+        self.check_read(index, offset, length)
+
         position = self.block_size * index + offset
+        parts = [file.read(file_offset, size) for file, file_offset, size in self.segments(position, length)]
 
-        while length != 0:
-            file = self.get_file_by_offset(position)
+        if len(parts) == 1:
+            return parts[0]
+        else:
+            return b''.join([as_bytes(part) for part in parts])
 
-            to_read = min(length, file.offset + file.size - position)
-            data += file.handle.read(to_read)
+    def locate_piece(self, index, offset, length):
+        '''
+        Returns `(file, file offset)` if the range lies in a single file on
+        disk, so it can be sent with sendfile, or `None`.
+        '''
 
-            length -= to_read
-            position += to_read
+        self.check_read(index, offset, length)
 
-        return data
+        segments = list(self.segments(self.block_size * index + offset, length))
+
+        if len(segments) != 1 or segments[0][0].path is None:
+            return None
+
+        file, file_offset, size = segments[0]
+
+        return file, file_offset
 
     def write_piece(self, index, offset, data):
         if offset >= self.block_size:
@@ -113,31 +492,209 @@ class DiskStorage(object):
         if index == self.num_blocks - 1 and offset + len(data) > self.last_block_size:
             raise ValueError('Cannot write past end of last block')
 
-        position = self.block_size * index + offset
+        # Nowhere to put blocks of skipped files
+        if not self.wanted[index]:
+            return False
 
-        while len(data) != 0:
-            file = self.get_file_by_offset(position)
+        with self.lock:
+            # We already have this block
+            if self.blocks[index]:
+                return False
 
-            to_write = min(len(data), file.size - position + file.offset)
-            file.handle.write(data[:to_write])
-            data = data[to_write:]
+            piece = self.pending.get(index)
 
-            position += to_write
+            if piece is None:
+                piece = self.pending[index] = PendingPiece(self.block_length(index))
+                self.buffered += piece.length
+                self.blocks[index] = False
 
-        self.verify_block(index, force=True)
+        # Copying, hashing and I/O only need the piece itself. AsyncStorage
+        # sends all writes of a piece to the same thread, so they stay in order.
+        with piece.lock:
+            if piece.buffer is not None:
+                piece.buffer[offset:offset + len(data)] = data
+            else:
+                self.write_range(self.block_size * index + offset, data)
 
-    def read_block(self, index):
+            piece.mark(offset, len(data))
+            self.absorb(index, piece)
+
+            if piece.complete:
+                return self.complete_piece(index, piece)
+
+        self.spill(keep=index)
+
+        return False
+
+    def write_range(self, position, data):
+        view = memoryview(data)
+        written = 0
+
+        for file, file_offset, size in self.segments(position, len(data)):
+            file.write(file_offset, view[written:written + size])
+            written += size
+
+    def absorb(self, index, piece):
+        '''
+        Feeds blocks to the piece's hash for as long as they arrived in order.
+        '''
+
+        length = piece.next_to_hash()
+
+        while length:
+            if piece.buffer is not None:
+                data = memoryview(piece.buffer)[piece.hashed:piece.hashed + length]
+            else:
+                data = self.read_piece(index, piece.hashed, length)
+
+            piece.hash.update(data)
+            piece.hashed += length
+            length = piece.next_to_hash()
+
+    def complete_piece(self, index, piece):
+        '''
+        Checks a piece whose blocks have all been hashed and writes it out.
+        Returns whether it was valid. Must be called with the piece's lock.
+        '''
+
+        valid = piece.hash.digest() == self.block_hash(index)
+
+        # Spilled pieces are already on disk
+        if valid and piece.buffer is not None:
+            self.write_range(self.block_size * index, piece.buffer)
+
+        with self.lock:
+            del self.pending[index]
+
+            if piece.buffer is not None:
+                self.buffered -= piece.length
+
+            self.blocks[index] = valid
+            save = valid and self.resume_path is not None and time.time() - self.resume_saved > self.resume_interval
+
+            if save:
+                self.resume_saved = time.time()
+
+        piece.buffer = None
+
+        if not valid:
+            logging.warning('Piece %d failed the hash check', index)
+
+            return False
+
+        if save:
+            self.save_resume()
+
+        return True
+
+    def spill(self, keep=None, limit=None, wait=False):
+        '''
+        Writes the oldest partial pieces to disk until at most `limit` bytes
+        (`buffer_size` by default) are buffered. Pieces that another thread is
+        working on are skipped, unless `wait` is set.
+        '''
+
+        limit = self.buffer_size if limit is None else limit
+
+        with self.lock:
+            pieces = [(index, piece) for index, piece in self.pending.items() if index != keep and piece.buffer is not None]
+
+        for index, piece in pieces:
+            with self.lock:
+                if self.buffered <= limit:
+                    break
+
+            if not piece.lock.acquire(wait):
+                continue
+
+            try:
+                # It may have been completed or spilled in the meantime
+                if piece.buffer is None:
+                    continue
+
+                for offset, length in piece.received_ranges():
+                    self.write_range(self.block_size * index + offset, memoryview(piece.buffer)[offset:offset + length])
+
+                with self.lock:
+                    piece.buffer = None
+                    self.buffered -= piece.length
+            finally:
+                piece.lock.release()
+
+    def flush(self):
+        self.spill(limit=0, wait=True)
+
+    def load_resume(self):
+        '''
+        Trusts the verified blocks that lie entirely in files that have not
+        changed since the resume record was written. The rest are left
+        unknown and get rechecked.
+        '''
+
+        result = resume.load(self.resume_path, self.info_hash, self.files, self.num_blocks)
+
+        if result is None:
+            return
+
+        blocks, unchanged = result
+        unchanged = dict(zip([id(file) for file in self.files], unchanged))
+
+        for index in range(self.num_blocks):
+            spanned = self.segments(self.block_size * index, self.block_length(index))
+
+            # Blocks that weren't verified may never have been checked at all
+            if blocks[index] and all(unchanged[id(file)] for file, file_offset, size in spanned):
+                self.blocks[index] = True
+
+        logging.info('Resumed %d of %d verified blocks', self.blocks.num_verified, self.num_blocks)
+
+    def save_resume(self):
+        with self.resume_lock:
+            self.resume_saved = time.time()
+
+            # The record must not claim blocks that could still be lost
+            for file in self.files:
+                file.sync()
+
+            resume.save(self.resume_path, self.info_hash, self.files, self.blocks)
+
+    def close(self):
+        '''
+        Writes out everything that is buffered and saves the resume record.
+        '''
+
+        self.flush()
+
+        if self.resume_path is not None:
+            self.save_resume()
+
+        self.handles.close()
+
+    def block_length(self, index):
         if index == self.num_blocks - 1:
-            return self.read_piece(index, 0, self.last_block_size)
+            return self.last_block_size
         else:
-            return self.read_piece(index, 0, self.block_size)
+            return self.block_size
+
+    def read_block(self, index):
+        return self.read_piece(index, 0, self.block_length(index))
 
     def write_block(self, index, data):
         if len(data) != self.block_size or (index == self.num_blocks - 1 and len(data) != self.last_block_size):
             raise ValueError('Data must fill an entire block')
 
         self.write_piece(index, 0, data)
-        self.verify_block(index, force=True)
+
+    def block_hash(self, index):
+        return self.pieces[20 * index:20 * index + 20]
+
+    def hash_block(self, index):
+        hash = hashlib.sha1()
+
+        for file, file_offset, size in self.segments(self.block_size * index, self.block_length(index)):
+            hash.update(file.read(file_offset, size))
+
+        return hash.digest()
 
     def verify_block(self, index, force=False):
         if not 0 <= index < self.num_blocks:
@@ -146,27 +703,90 @@ class DiskStorage(object):
         if not force and self.blocks[index] is not None:
             return self.blocks[index]
 
-        verified = hashlib.sha1(self.read_block(index)).digest() == self.block_hashes[index]
+        verified = self.hash_block(index) == self.block_hash(index)
         self.blocks[index] = verified
 
         return verified
 
+    def recheck_batches(self, indexes):
+        '''
+        Groups runs of consecutive block indexes into batches of file segments
+        for `hash_in_pool`. Yields `(first index, number of blocks, batch)`.
+        '''
+
+        max_blocks = max(1, self.recheck_batch_size // self.block_size)
+        runs = []
+
+        for index in sorted(indexes):
+            if runs and runs[-1][0] + runs[-1][1] == index and runs[-1][1] < max_blocks:
+                runs[-1][1] += 1
+            else:
+                runs.append([index, 1])
+
+        for first, count in runs:
+            position = self.block_size * first
+            length = min(self.block_size * count, self.size - position)
+            segments = [(file.path, file.locate(file_offset, size), size) for file, file_offset, size in self.segments(position, length)]
+
+            yield first, count, (segments, self.block_size)
+
+    def recheck(self, indexes=None, progress=None, executor='thread'):
+        '''
+        Hashes blocks (all of them by default) on a pool of `workers` threads
+        or processes, recording the results as they arrive. `progress` is
+        called with the number of checked blocks and the total.
+
+        Blocks of skipped files are left out, as their data isn't kept.
+        '''
+
+        indexes = range(self.num_blocks) if indexes is None else indexes
+        indexes = [index for index in indexes if self.wanted[index]]
+        batches = list(self.recheck_batches(indexes))
+        results = hash_in_pool((batch for first, count, batch in batches), self.workers, executor)
+        checked = 0
+
+        for first, count, batch in batches:
+            digests = next(results)
+
+            for offset in range(count):
+                index = first + offset
+                self.blocks[index] = digests[20 * offset:20 * offset + 20] == self.block_hash(index)
+
+            checked += count
+
+            if progress is not None:
+                progress(checked, len(indexes))
+
+        return all(self.blocks[index] for index in indexes)
+
     def verify(self):
-        for index in range(self.num_blocks):
-            self.verify_block(index)
+        '''
+        Checks the wanted blocks that are in an unknown state. Returns whether
+        all of them have been downloaded.
+        '''
+
+        if self.blocks.num_wanted_known < self.blocks.num_wanted:
+            self.recheck([index for index in range(self.num_blocks) if self.blocks[index] is None and self.wanted[index]])
 
-        return all(self.blocks)
+        return self.blocks.complete
 
     def to_bitfield(self):
-        return {index: self.verify_block(index) for index in range(self.num_blocks)}
+        '''
+        Returns the wire bitfield of verified blocks.
+        '''
+
+        self.verify()
+
+        return self.blocks.to_bytes()
 
     def piece_chart(self):
-        return ''.join(['*' if self.verify_block(index) else '.' for index in range(self.num_blocks)])
+        return ''.join(['*' if self.blocks[index] else '.' if self.wanted[index] else ' ' for index in range(self.num_blocks)])
 
     def percentage(self):
-        b = self.to_bitfield()
+        if not self.blocks.num_wanted:
+            return 100.0
 
-        return 100 * float(sum(b.values())) / float(len(b))
+        return 100 * float(self.blocks.num_wanted_verified) / self.blocks.num_wanted
 
     def __str__(self):
         return '<{self.__class__.__name__} {chart} {percent}%>'.format(
@@ -176,9 +796,7 @@ class DiskStorage(object):
         )
 
     def __del__(self):
-        for file in self.files:
-            file.handle.close()
-            del file
+        self.close()
 
 if __name__ == '__main__':
     from torrent import Torrent
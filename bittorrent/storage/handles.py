@@ -0,0 +1,103 @@
+import threading
+
+from collections import OrderedDict
+
+class HandlePool(object):
+    '''
+    Keeps at most `max_open` file handles open, closing the least recently
+    used ones. Files are opened on first access, read-only if `read_only`
+    says nothing will be written to them.
+
+    Handles that are in use when they get evicted are closed once they are
+    released, so the limit can be exceeded briefly by the number of threads
+    doing I/O.
+    '''
+
+    def __init__(self, max_open=256, read_only=None):
+        self.max_open = max(1, max_open)
+        self.read_only = read_only
+
+        self.handles = OrderedDict()
+        self.users = {}
+        self.retired = set()
+        self.lock = threading.Lock()
+
+        self.opens = 0
+        self.evictions = 0
+
+    def acquire(self, file, write=False):
+        '''
+        Returns an open handle for `file`, which must be given back with
+        `release`. `write` asks for a handle that can be written to.
+        '''
+
+        with self.lock:
+            handle = self.handles.pop(file, None)
+
+            # A read-only handle for a file that is written to again
+            if handle is not None and write and handle.mode == 'rb':
+                self.retire(handle)
+                handle = None
+
+            if handle is None:
+                read_only = not write and self.read_only is not None and self.read_only(file)
+                handle = open(file.path, 'rb' if read_only else 'r+b')
+                self.opens += 1
+
+            self.handles[file] = handle
+            self.users[handle] = self.users.get(handle, 0) + 1
+
+            while len(self.handles) > self.max_open:
+                evicted_file, evicted = self.handles.popitem(last=False)
+                self.retire(evicted)
+                self.evictions += 1
+
+            return handle
+
+    def release(self, handle):
+        with self.lock:
+            self.users[handle] -= 1
+
+            if not self.users[handle]:
+                del self.users[handle]
+
+                if handle in self.retired:
+                    self.retired.remove(handle)
+                    handle.close()
+
+    def retire(self, handle):
+        if handle in self.users:
+            self.retired.add(handle)
+        else:
+            handle.close()
+
+    def discard(self, file):
+        '''
+        Forgets about a file that is no longer part of the storage.
+        '''
+
+        with self.lock:
+            handle = self.handles.pop(file, None)
+
+            if handle is not None:
+                self.retire(handle)
+
+    def close(self):
+        '''
+        Closes every handle that is not in use.
+        '''
+
+        with self.lock:
+            for handle in self.handles.values():
+                self.retire(handle)
+
+            self.handles.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'open': len(self.handles),
+                'max_open': self.max_open,
+                'opens': self.opens,
+                'evictions': self.evictions
+            }
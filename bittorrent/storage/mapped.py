@@ -0,0 +1,110 @@
+import mmap
+import threading
+
+from collections import OrderedDict
+
+from bittorrent.utils import as_bytes
+from bittorrent.storage.disk import DiskStorage
+
+try:
+    # Python 2's mmap only supports the old buffer protocol and string
+    # slice assignment
+    map_view = buffer
+    writable = as_bytes
+except NameError:
+    def map_view(mapping, offset, size):
+        return memoryview(mapping)[offset:offset + size]
+
+    def writable(data):
+        return data
+
+class MappedFile(object):
+    '''
+    A file that is memory-mapped in windows of `window_size` bytes, so files
+    larger than the address space can still be served.
+    '''
+
+    def __init__(self, path, size, window_size, max_windows=4):
+        self.path = path
+        self.size = size
+        self.offset = None
+        self.pool = None
+
+        self.window_size = window_size - window_size % mmap.ALLOCATIONGRANULARITY
+        self.max_windows = max_windows
+        self.windows = OrderedDict()
+        self.lock = threading.Lock()
+
+    def window(self, index):
+        with self.lock:
+            try:
+                mapping = self.windows.pop(index)
+            except KeyError:
+                start = index * self.window_size
+                length = min(self.window_size, self.size - start)
+                handle = self.pool.acquire(self, write=True)
+
+                # The mapping stays valid after the handle is closed
+                try:
+                    mapping = mmap.mmap(handle.fileno(), length, offset=start)
+                finally:
+                    self.pool.release(handle)
+
+                # Mappings are closed once the last view into them is gone
+                while len(self.windows) >= self.max_windows:
+                    self.windows.popitem(last=False)
+
+            self.windows[index] = mapping
+
+            return mapping
+
+    def ranges(self, offset, length):
+        '''
+        Yields `(mapping, mapping offset, length)` for every window the range
+        spans.
+        '''
+
+        while length > 0:
+            index, start = divmod(offset, self.window_size)
+            size = min(length, self.window_size - start)
+
+            yield self.window(index), start, size
+
+            offset += size
+            length -= size
+
+    def sync(self):
+        with self.lock:
+            windows = list(self.windows.values())
+
+        for mapping in windows:
+            mapping.flush()
+
+    def locate(self, offset, length):
+        return offset
+
+    def read(self, offset, length):
+        views = [map_view(mapping, start, size) for mapping, start, size in self.ranges(offset, length)]
+
+        if len(views) == 1:
+            return views[0]
+        else:
+            return b''.join([as_bytes(view) for view in views])
+
+    def write(self, offset, data):
+        written = 0
+
+        for mapping, start, size in self.ranges(offset, len(data)):
+            mapping[start:start + size] = writable(data[written:written + size])
+            written += size
+
+class MmapStorage(DiskStorage):
+    '''
+    Storage that serves pieces as views straight into memory-mapped files.
+    '''
+
+    window_size = 2**28
+
+    @classmethod
+    def open_file(cls, path, size):
+        return MappedFile(path, size, cls.window_size)
@@ -0,0 +1,75 @@
+from bittorrent.storage.disk import DiskStorage, NORMAL
+
+class MemoryFile(object):
+    '''
+    A file of the torrent that lives in a slice of a shared bytearray.
+    '''
+
+    def __init__(self, data, start, size):
+        self.data = data
+        self.start = start
+        self.size = size
+        self.offset = None
+        self.path = None
+        self.pool = None
+
+    def locate(self, offset, length):
+        return offset
+
+    def sync(self):
+        pass
+
+    def read(self, offset, length):
+        start = self.start + offset
+
+        return memoryview(self.data)[start:start + length]
+
+    def write(self, offset, data):
+        start = self.start + offset
+        self.data[start:start + len(data)] = data
+
+class MemoryStorage(DiskStorage):
+    '''
+    Storage that keeps the whole torrent in a single bytearray, so the
+    protocol can be tested and measured without touching the disk. It is
+    empty unless `data` is given, in which case it gets verified like a
+    complete download would.
+    '''
+
+    @classmethod
+    def from_torrent(cls, torrent, base_path=None, resume=False, allocation=None, data=None, priorities=None, **kwargs):
+        info = torrent.info
+        size = sum(entry.length for entry in info.files)
+
+        if data is None:
+            data = bytearray(size)
+        elif len(data) != size:
+            raise ValueError('Data must be {0} bytes long'.format(size))
+        else:
+            data = bytearray(data)
+
+        files = [MemoryFile(data, entry.offset, entry.length) for entry in info.files]
+
+        storage = cls(files, info.piece_length, info.pieces, priorities=priorities or [NORMAL] * len(files), **kwargs)
+        storage.data = data
+        storage.allocation_time = 0
+
+        return storage
+
+    def recheck(self, indexes=None, progress=None, executor=None):
+        '''
+        Hashes blocks (all of them by default) in the calling thread. There
+        is no disk to wait on, so a pool would not help. Blocks of skipped
+        files are left out, like on disk.
+        '''
+
+        indexes = range(self.num_blocks) if indexes is None else indexes
+        indexes = [index for index in indexes if self.wanted[index]]
+
+        for checked, index in enumerate(indexes, 1):
+            self.verify_block(index, force=True)
+
+            if progress is not None:
+                progress(checked, len(indexes))
+
+        return all(self.blocks[index] for index in indexes)
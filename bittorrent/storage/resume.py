@@ -0,0 +1,58 @@
+import os
+import logging
+
+from bittorrent import bencode
+from bittorrent.utils import unpack_bits
+
+def file_stat(file):
+    '''
+    Returns the `(size, mtime in microseconds)` a file is recognized by.
+    '''
+
+    stat = os.stat(file.path)
+
+    return stat.st_size, int(stat.st_mtime * 1000000)
+
+def save(path, info_hash, files, blocks):
+    '''
+    Atomically writes a resume record for the verified blocks.
+    '''
+
+    record = {
+        'info hash': info_hash,
+        'pieces': blocks.to_bytes(),
+        'files': [list(file_stat(file)) for file in files]
+    }
+
+    temporary_path = path + '.part'
+
+    with open(temporary_path, 'wb') as handle:
+        bencode.encode_to(record, handle)
+        handle.flush()
+        os.fsync(handle.fileno())
+
+    os.rename(temporary_path, path)
+
+def load(path, info_hash, files, num_blocks):
+    '''
+    Reads a resume record. Returns the verified blocks and which files are
+    unchanged since it was written, or `None` if it does not apply.
+    '''
+
+    try:
+        with open(path, 'rb') as handle:
+            record = bencode.decode_file(handle)
+
+        if record['info hash'] != info_hash or len(record['files']) != len(files):
+            logging.warning('Resume data in %s is for a different torrent', path)
+            return None
+
+        blocks = unpack_bits(record['pieces'], num_blocks)
+        unchanged = [list(file_stat(file)) == stat for file, stat in zip(files, record['files'])]
+    except (IOError, OSError):
+        return None
+    except (ValueError, KeyError, TypeError, IndexError):
+        logging.warning('Ignoring corrupt resume data in %s', path)
+        return None
+
+    return blocks, unchanged
@@ -0,0 +1,106 @@
+from bittorrent.utils import ceil_div, pack_bits, popcount
+
+class BlockState(object):
+    '''
+    The state of every block: `None` while unknown, then `True` once it is
+    verified or `False` if it is missing. Indexing works like a list of
+    those values.
+
+    States are kept as bit arrays in wire order, so the bitfield we send is
+    a copy of `verified`, and the counters are kept up to date as blocks
+    change, for the ones that are wanted as well.
+    '''
+
+    def __init__(self, count):
+        self.count = count
+
+        self.verified = bytearray(ceil_div(count, 8))
+        self.known = bytearray(ceil_div(count, 8))
+        self.wanted = bytearray(b'\xff' * ceil_div(count, 8))
+
+        # Bits past the end are never wanted
+        if count % 8:
+            self.wanted[-1] = (0xff00 >> (count % 8)) & 0xff
+
+        self.num_verified = 0
+        self.num_known = 0
+        self.num_wanted = count
+        self.num_wanted_verified = 0
+        self.num_wanted_known = 0
+
+    def locate(self, index):
+        if index < 0:
+            index += self.count
+
+        if not 0 <= index < self.count:
+            raise IndexError('Block index out of range')
+
+        return index >> 3, 0x80 >> (index & 7)
+
+    def __getitem__(self, index):
+        byte, mask = self.locate(index)
+
+        if not self.known[byte] & mask:
+            return None
+
+        return bool(self.verified[byte] & mask)
+
+    def __setitem__(self, index, state):
+        byte, mask = self.locate(index)
+        state = None if state is None else bool(state)
+        known = bool(self.known[byte] & mask)
+        verified = bool(self.verified[byte] & mask)
+        wanted = int(bool(self.wanted[byte] & mask))
+
+        if state is None:
+            self.known[byte] &= ~mask
+            self.num_known -= known
+            self.num_wanted_known -= known * wanted
+        elif not known:
+            self.known[byte] |= mask
+            self.num_known += 1
+            self.num_wanted_known += wanted
+
+        if state and not verified:
+            self.verified[byte] |= mask
+            self.num_verified += 1
+            self.num_wanted_verified += wanted
+        elif verified and not state:
+            self.verified[byte] &= ~mask
+            self.num_verified -= 1
+            self.num_wanted_verified -= wanted
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for index in range(self.count):
+            yield self[index]
+
+    def set_wanted(self, wanted):
+        self.wanted = bytearray(pack_bits(wanted))
+        self.num_wanted = popcount(self.wanted)
+        self.num_wanted_verified = popcount(self.verified, self.wanted)
+        self.num_wanted_known = popcount(self.known, self.wanted)
+
+    def clear(self):
+        '''
+        Forgets the state of every block.
+        '''
+
+        self.verified[:] = bytearray(len(self.verified))
+        self.known[:] = bytearray(len(self.known))
+
+        self.num_verified = self.num_known = 0
+        self.num_wanted_verified = self.num_wanted_known = 0
+
+    @property
+    def complete(self):
+        return self.num_wanted_verified == self.num_wanted
+
+    def to_bytes(self):
+        '''
+        Returns the verified blocks as a wire bitfield.
+        '''
+
+        return bytes(self.verified)
@@ -0,0 +1,119 @@
+import sys
+import time
+import threading
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+class AsyncStorage(object):
+    '''
+    Runs storage reads, writes and hashes on a pool of `workers` threads so
+    the IOLoop never waits on the disk. Every method returns a Future that
+    resolves on the IOLoop.
+
+    Operations on the same piece always go to the same worker, so they run
+    in the order they were submitted. Different pieces never share bytes,
+    which makes this enough to keep every file consistent.
+    '''
+
+    def __init__(self, storage, workers=4, io_loop=None):
+        self.storage = storage
+        self.io_loop = io_loop or IOLoop.current()
+
+        self.queues = [Queue() for i in range(workers)]
+        self.threads = []
+
+        for queue in self.queues:
+            thread = threading.Thread(target=self.work, args=(queue,))
+            thread.daemon = True
+            thread.start()
+
+            self.threads.append(thread)
+
+        # Statistics for sizing the pool
+        self.stats_lock = threading.Lock()
+        self.submitted = 0
+        self.completed = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def submit(self, index, function, *args):
+        future = Future()
+
+        with self.stats_lock:
+            self.submitted += 1
+
+        self.queues[index % len(self.queues)].put((future, time.time(), function, args))
+
+        return future
+
+    def work(self, queue):
+        while True:
+            task = queue.get()
+
+            if task is None:
+                return
+
+            future, submitted, function, args = task
+
+            try:
+                callback = future.set_result, function(*args)
+            except Exception:
+                callback = future.set_exc_info, sys.exc_info()
+
+            latency = time.time() - submitted
+
+            with self.stats_lock:
+                self.completed += 1
+                self.total_latency += latency
+                self.max_latency = max(self.max_latency, latency)
+
+            self.io_loop.add_callback(*callback)
+
+    def read_piece(self, index, offset, length):
+        return self.submit(index, self.storage.read_piece, index, offset, length)
+
+    def write_piece(self, index, offset, data):
+        return self.submit(index, self.storage.write_piece, index, offset, data)
+
+    def verify_block(self, index, force=False):
+        return self.submit(index, self.storage.verify_block, index, force)
+
+    def verify(self):
+        return self.submit(0, self.storage.verify)
+
+    @property
+    def queue_depth(self):
+        return sum(queue.qsize() for queue in self.queues)
+
+    def stats(self):
+        '''
+        Returns the queue depth and the latency (queueing included) of
+        completed operations, in seconds.
+        '''
+
+        with self.stats_lock:
+            return {
+                'workers': len(self.threads),
+                'queue_depth': self.queue_depth,
+                'in_flight': self.submitted - self.completed,
+                'completed': self.completed,
+                'average_latency': self.total_latency / self.completed if self.completed else 0.0,
+                'max_latency': self.max_latency
+            }
+
+    def close(self):
+        '''
+        Finishes the queued operations and stops the workers.
+        '''
+
+        for queue in self.queues:
+            queue.put(None)
+
+        for thread in self.threads:
+            thread.join()
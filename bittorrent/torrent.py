@@ -1,27 +1,83 @@
+import copy
 import hashlib
+import binascii
+
+from collections import namedtuple
 
 from . import bencode
 from .tracker import Tracker
-from .utils import grouper
+from .utils import ceil_div
+
+FileEntry = namedtuple('FileEntry', ['path', 'length', 'offset'])
+
+class TorrentInfo(object):
+    '''
+    Compiled form of a torrent's info dictionary.
+    '''
+
+    __slots__ = ('name', 'piece_length', 'pieces', 'num_pieces', 'last_piece_length',
+                 'files', 'length', 'info_hash')
+
+    def __init__(self, info, info_hash):
+        self.name = info['name']
+        self.piece_length = info['piece length']
+        self.pieces = info['pieces']
+        self.info_hash = info_hash
+
+        if 'length' in info:
+            self.files = (FileEntry((self.name,), info['length'], 0),)
+        else:
+            files = []
+            offset = 0
+
+            for file in info['files']:
+                files.append(FileEntry((self.name,) + tuple(file['path']), file['length'], offset))
+                offset += file['length']
+
+            self.files = tuple(files)
+
+        self.length = sum(file.length for file in self.files)
+        self.num_pieces = ceil_div(self.length, self.piece_length)
+        self.last_piece_length = self.length - self.piece_length * (self.num_pieces - 1)
+
+        if len(self.pieces) != 20 * self.num_pieces:
+            raise ValueError('Expected {0} piece hashes, got {1} bytes'.format(self.num_pieces, len(self.pieces)))
+
+    def piece_hash(self, index):
+        return self.pieces[20 * index:20 * index + 20]
+
+    def piece_size(self, index):
+        if index == self.num_pieces - 1:
+            return self.last_piece_length
+        else:
+            return self.piece_length
 
 class Torrent(object):
     def __init__(self, handle=None):
+        raw = {}
+
         if isinstance(handle, dict):
             self.meta = handle
         elif isinstance(handle, basestring):
             try:
-                self.meta = bencode.decode(handle)
+                self.meta, raw = bencode.decode(handle, raw_keys=['info'])
             except ValueError:
                 try:
                     with open(handle, 'rb') as input_file:
-                        self.meta = bencode.decode(input_file.read())
+                        self.meta, raw = bencode.decode_file(input_file, raw_keys=['info'])
                 except IOError:
                     raise TypeError('handle must be a file, dict, path, or bencoded string. Got: {0}'.format(type(handle)))
         elif hasattr(handle, 'read'):
-            self.meta = bencode.decode(handle.read())
+            self.meta, raw = bencode.decode_file(handle, raw_keys=['info'])
         else:
             self.meta = {}
 
+        # The info hash is computed from the original bytes when we have them.
+        # It stays cached for as long as `meta['info']` equals this snapshot.
+        self._info = copy.deepcopy(self.meta.get('info'))
+        self._info_hash = hashlib.sha1(raw['info']).digest() if 'info' in raw else None
+        self._compiled_info = None
+
         self.uploaded = 1000000
         self.downloaded = 1000000
         self.remaining = 10000000
@@ -33,15 +89,33 @@ class Torrent(object):
 
     def save(self, filename):
         with open(filename, 'wb') as handle:
-            handle.write(self.bencode())
+            bencode.encode_to(self.meta, handle)
+
+    def _refresh_info(self):
+        info = self.meta['info']
+
+        # Comparing is cheap, since the snapshot shares its strings with `info`
+        if self._info_hash is None or self._info != info:
+            self._info = copy.deepcopy(info)
+            self._info_hash = hashlib.sha1(bencode.encode(self._info)).digest()
+            self._compiled_info = None
+
+    @property
+    def info(self):
+        self._refresh_info()
+
+        if self._compiled_info is None:
+            self._compiled_info = TorrentInfo(self._info, self._info_hash)
+
+        return self._compiled_info
 
     def info_hash(self, hex=False):
-        hash = hashlib.sha1(bencode.encode(self.meta['info']))
+        self._refresh_info()
 
         if hex:
-            return hash.hexdigest()
+            return binascii.hexlify(self._info_hash)
         else:
-            return hash.digest()
+            return self._info_hash
 
     def _trackers(self):
         trackers = self.meta.get('announce-list', [[self.meta['announce']]])
@@ -60,7 +134,7 @@ class Torrent(object):
 
     @property
     def piece_hashes(self):
-        hashes = grouper(20, self.meta['info']['pieces'])
+        info = self.info
 
-        for index, hash in enumerate(hashes):
-            yield ''.join(hash)
+        for index in range(info.num_pieces):
+            yield info.piece_hash(index)
@@ -20,7 +20,7 @@ class HTTPTracker(object):
     @coroutine
     def announce(self, peer_id, port, event=None, num_wanted=None, compact=True, no_peer_id=None):
         params = {
-            'info_hash': self.torrent.info_hash(),
+            'info_hash': self.torrent.info.info_hash,
             'peer_id': peer_id,
             'port': port,
             'uploaded': self.torrent.uploaded,
@@ -43,8 +43,10 @@ class HTTPTracker(object):
 
         tracker_url = url_concat(self.url, params)
 
-        response = yield self.client.fetch(tracker_url)
-        decoded_body = bencode.decode(response.body)
+        decoder = bencode.StreamDecoder()
+
+        yield self.client.fetch(tracker_url, streaming_callback=decoder.feed)
+        decoded_body = decoder.close()
 
         if 'failure reason' in decoded_body:
             raise TrackerFailure(decoded_body['failure reason'])
@@ -160,7 +160,7 @@ class UDPTracker(object):
                 action=1,
                 structure='!20s20sQQQIIIiH',
                 arguments=[
-                    self.torrent.info_hash(),
+                    self.torrent.info.info_hash,
                     peer_id,
                     self.torrent.downloaded,
                     self.torrent.remaining,
@@ -1,6 +1,7 @@
 import os
 import sys
 import errno
+import binascii
 import struct
 import inspect
 import logging
@@ -26,9 +27,65 @@ def grouper(n, iterable, fillvalue=None):
 
     return itertools.izip_longest(fillvalue=fillvalue, *args)
 
+def as_bytes(data):
+    '''
+    Copies any buffer (memoryview, bytearray, buffer) into a byte string.
+    '''
+
+    if isinstance(data, bytes):
+        return data
+    elif isinstance(data, memoryview):
+        return data.tobytes()
+    else:
+        return bytes(data)
+
 def ceil_div(a, b):
     return a // b + int(bool(a % b))
 
+def pack_bits(bits):
+    '''
+    Packs booleans into bytes, most significant bit first.
+    '''
+
+    data = bytearray(ceil_div(len(bits), 8))
+
+    for index, bit in enumerate(bits):
+        if bit:
+            data[index // 8] |= 0x80 >> (index % 8)
+
+    return bytes(data)
+
+def unpack_bits(data, count):
+    data = bytearray(data)
+
+    if len(data) < ceil_div(count, 8):
+        raise ValueError('Not enough data for {0} bits'.format(count))
+
+    return [bool(data[index // 8] & (0x80 >> (index % 8))) for index in range(count)]
+
+def bytes_to_int(data):
+    '''
+    Reads bytes as one big-endian integer, so bit arrays can be combined
+    and counted a whole at a time.
+    '''
+
+    return int(binascii.hexlify(data), 16) if data else 0
+
+def int_to_bytes(value, size):
+    return binascii.unhexlify('%0*x' % (2 * size, value))
+
+def popcount(data, mask=None):
+    '''
+    Counts the set bits in `data`, only where they are set in `mask` too.
+    '''
+
+    value = bytes_to_int(data)
+
+    if mask is not None:
+        value &= bytes_to_int(mask)
+
+    return bin(value).count('1')
+
 def fill(handle, size):
     block_size = 2**18
     zeroes = '\x00' * block_size
@@ -40,14 +97,41 @@ def fill(handle, size):
     handle.write('\x00' * (size - block_size * (size // block_size)))
     handle.seek(0)
 
-def create_and_open(name, mode='r', size=None):
+ALLOCATION_STRATEGIES = ('sparse', 'full', 'zero')
+
+def check_allocation(strategy):
+    if strategy not in ALLOCATION_STRATEGIES:
+        raise ValueError('Unknown allocation strategy: {0}'.format(strategy))
+
+def allocate(handle, size, strategy='sparse'):
+    '''
+    Grows a file to `size` bytes. `sparse` only sets the length, `full`
+    reserves the blocks with `posix_fallocate` and `zero` writes out zeros.
+    '''
+
+    if strategy == 'sparse':
+        handle.truncate(size)
+    elif strategy == 'full' and hasattr(os, 'posix_fallocate'):
+        handle.flush()
+
+        if size:
+            os.posix_fallocate(handle.fileno(), 0, size)
+    else:
+        check_allocation(strategy)
+
+        # Without posix_fallocate, writing zeros is the only way to reserve space
+        fill(handle, size)
+
+def create_and_open(name, mode='r', size=None, allocation='sparse'):
+    check_allocation(allocation)
+
     try:
         return open(name, mode)
     except IOError:
         with open(name, 'wb') as handle:
-            fill(handle, size)
-    finally:
-        return open(name, mode)
+            allocate(handle, size, allocation)
+
+    return open(name, mode)
 
 def mkdirs(path):
     try:
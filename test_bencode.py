@@ -1,3 +1,4 @@
+import io
 import unittest
 
 from bittorrent import bencode, utils
@@ -29,6 +30,17 @@ class TestBencode(unittest.TestCase):
             ]
         }), 'd3:fool3:bard4:testl5:againi12eeee4:testi12ee')
 
+    def test_keys(self):
+        self.assertEqual(bencode.encode({u'b': 1, 'a': 2}), 'd1:ai2e1:bi1ee')
+        self.assertEqual(bencode.encode({u'\xe9': 1}), 'd2:\xc3\xa9i1ee')
+        self.assertRaises(TypeError, bencode.encode, {1: 2})
+
+    def test_encode_to(self):
+        handle = io.BytesIO()
+        bencode.encode_to({'test': ['foo', 12]}, handle)
+
+        self.assertEqual(handle.getvalue(), 'd4:testl3:fooi12eee')
+
 class TestBdecode(unittest.TestCase):
     def test_string(self):
         self.assertEqual(bencode.decode('4:test'), 'test')
@@ -62,6 +74,76 @@ class TestBdecode(unittest.TestCase):
         self.assertRaises(ValueError, bencode.decode, 'i-0e')
         self.assertRaises(ValueError, bencode.decode, '')
 
+    def test_malformed(self):
+        self.assertRaises(ValueError, bencode.decode, 'i03e')
+        self.assertRaises(ValueError, bencode.decode, 'i12')
+        self.assertRaises(ValueError, bencode.decode, 'ie')
+        self.assertRaises(ValueError, bencode.decode, '03:foo')
+        self.assertRaises(ValueError, bencode.decode, '5:test')
+        self.assertRaises(ValueError, bencode.decode, 'l4:test')
+        self.assertRaises(ValueError, bencode.decode, 'd4:test')
+        self.assertRaises(ValueError, bencode.decode, 'x')
+
+    def test_raw_keys(self):
+        value, raw = bencode.decode('d4:infod1:bi1e1:ai2ee3:keyl1:xee', raw_keys=['info'])
+
+        self.assertEqual(value['info'], {'a': 2, 'b': 1})
+        self.assertEqual(raw, {'info': 'd1:bi1e1:ai2ee'})
+
+    def test_buffers(self):
+        self.assertEqual(bencode.decode(memoryview(b'l4:testi3ee')), [b'test', 3])
+        self.assertEqual(bencode.decode(bytearray(b'd1:a1:be')), {b'a': b'b'})
+
+class TestStreamDecode(unittest.TestCase):
+    data = 'd3:fool3:bard4:testl5:againi-12eeee4:test10:0123456789e'
+
+    def test_chunks(self):
+        for size in (1, 2, 3, 7, len(self.data)):
+            decoder = bencode.StreamDecoder()
+
+            for start in range(0, len(self.data), size):
+                decoder.feed(self.data[start:start + size])
+
+            self.assertEqual(decoder.close(), bencode.decode(self.data))
+
+    def test_raw_keys(self):
+        data = 'd4:infod1:bi1e1:a3:xyze3:keyl1:xe1:zi3ee'
+
+        for size in (1, 2, 5, len(data)):
+            decoder = bencode.StreamDecoder(raw_keys=['info', 'z'])
+
+            for start in range(0, len(data), size):
+                decoder.feed(data[start:start + size])
+
+            self.assertEqual(decoder.close()['info'], {'a': 'xyz', 'b': 1})
+            self.assertEqual(decoder.raw, {'info': 'd1:bi1e1:a3:xyze', 'z': 'i3e'})
+
+    def test_callback(self):
+        results = []
+        decoder = bencode.StreamDecoder(callback=results.append)
+        decoder.feed('l4:te')
+        self.assertEqual(results, [])
+        decoder.feed('stee')
+        self.assertEqual(results, [['test']])
+
+    def test_events(self):
+        parser = bencode.StreamParser()
+        events = parser.feed('d1:al') + parser.feed('i1e') + parser.feed('ee')
+
+        self.assertEqual(events, [
+            ('dict', None), ('str', 'a'), ('list', None),
+            ('int', 1), ('end', None), ('end', None)
+        ])
+
+    def test_errors(self):
+        self.assertRaises(ValueError, bencode.StreamDecoder().feed, 'di1ei1ee')
+        self.assertRaises(ValueError, bencode.StreamDecoder().feed, 'd1:ae')
+        self.assertRaises(ValueError, bencode.StreamDecoder().feed, 'i-0e')
+
+        decoder = bencode.StreamDecoder()
+        decoder.feed('l4:te')
+        self.assertRaises(ValueError, decoder.close)
+
 
 if __name__ == '__main__':
     unittest.main()
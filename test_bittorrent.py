@@ -1,17 +1,528 @@
+import os
+import errno
+import mmap
+import socket
+import threading
+import shutil
+import hashlib
+import tempfile
 import unittest
 import struct
 
-from tornado.testing import AsyncTestCase, gen_test
+from tornado.gen import coroutine, sleep, Return
+from tornado.testing import AsyncTestCase, ExpectLog, gen_test
+from tornado.iostream import IOStream
 
-from bittorrent import utils
+from bittorrent import utils, create, bencode
 from bittorrent.torrent import Torrent
-from bittorrent.protocol.message import KeepAlive, Choke, Have, Bitfield
+from bittorrent.peer import Peer
+from bittorrent.p2p import Server, Client
+from bittorrent.storage.state import BlockState
+from bittorrent.storage import DiskStorage, MmapStorage, MemoryStorage, AsyncStorage, ReadCache, SKIP, NORMAL, HIGH
+from bittorrent.protocol.message import (Messages, KeepAlive, Choke, Unchoke, Have, Bitfield, Piece, Request, Cancel, Interested,
+                                         HaveAll, HaveNone, Reject, AllowedFast, Suggest)
+from bittorrent.protocol.fast import allowed_fast_set
+from bittorrent.protocol.framing import Framer, max_message_length
+from bittorrent.p2p import writer as writer_module
+from bittorrent.p2p.writer import MessageWriter
 from bittorrent.tracker import Tracker, HTTPTracker, UDPTracker, TrackerResponse
 
+def receiver_for(stream):
+    '''
+    Returns a coroutine that reads the next `count` messages off `stream`.
+    '''
+
+    framer = Framer()
+    messages = []
+
+    @coroutine
+    def receive(count):
+        while len(messages) < count:
+            chunk = yield stream.read_bytes(2**16, partial=True)
+            messages.extend(Messages[id].unpack(body) for id, body in framer.feed(chunk))
+
+        received = messages[:count]
+        del messages[:count]
+
+        raise Return(received)
+
+    return receive
+
 class TestTorrentReader(unittest.TestCase):
     def test_read(self):
         Torrent('torrents/archlinux-2013.12.01-dual.iso.torrent')
 
+    def test_info_hash(self):
+        # Keys are not sorted, so re-encoding would give a different hash
+        info = 'd4:name1:a6:lengthi5e12:piece lengthi5e6:pieces0:e'
+        torrent = Torrent('d8:announce16:http://localhost4:info' + info + 'e')
+
+        self.assertEqual(torrent.info_hash(), hashlib.sha1(info).digest())
+        self.assertEqual(torrent.info_hash(hex=True), hashlib.sha1(info).hexdigest())
+        self.assertNotEqual(torrent.info_hash(), hashlib.sha1(bencode.encode(torrent.meta['info'])).digest())
+
+        torrent.meta['announce'] = 'bar'
+        self.assertEqual(torrent.info_hash(), hashlib.sha1(info).digest())
+
+        # Changes in place are noticed too
+        torrent.meta['info']['private'] = 1
+        self.assertEqual(torrent.info_hash(), hashlib.sha1(bencode.encode(torrent.meta['info'])).digest())
+
+        torrent.meta['info'] = {'name': 'b'}
+        self.assertEqual(torrent.info_hash(), hashlib.sha1('d4:name1:be').digest())
+
+    def test_info(self):
+        pieces = ''.join(chr(i) * 20 for i in range(4))
+        torrent = Torrent({
+            'announce': 'http://localhost',
+            'info': {
+                'name': 'dir',
+                'piece length': 4,
+                'pieces': pieces,
+                'files': [
+                    {'path': ['a'], 'length': 5},
+                    {'path': ['sub', 'b'], 'length': 8}
+                ]
+            }
+        })
+
+        info = torrent.info
+
+        self.assertIs(info, torrent.info)
+        self.assertEqual([tuple(f) for f in info.files], [(('dir', 'a'), 5, 0), (('dir', 'sub', 'b'), 8, 5)])
+        self.assertEqual((info.length, info.num_pieces, info.last_piece_length), (13, 4, 1))
+        self.assertEqual(info.piece_hash(2), chr(2) * 20)
+        self.assertEqual(list(torrent.piece_hashes), [pieces[i:i + 20] for i in range(0, 80, 20)])
+        self.assertEqual(info.info_hash, torrent.info_hash())
+
+class TestCreate(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_create(self):
+        contents = [os.urandom(size) for size in (100, 0, 70, 333)]
+        path = os.path.join(self.directory, 'data')
+        os.makedirs(os.path.join(path, 'sub'))
+
+        for index, content in enumerate(contents):
+            with open(os.path.join(path, 'sub' if index == 3 else '', 'file{0}'.format(index)), 'wb') as handle:
+                handle.write(content)
+
+        data = ''.join(contents)
+        expected = ''.join(hashlib.sha1(data[i:i + 64]).digest() for i in range(0, len(data), 64))
+
+        for executor in ('thread', 'process'):
+            torrent = create.create(path, 'http://localhost/announce', piece_length=64, workers=2, executor=executor)
+            saved = os.path.join(self.directory, 'data.torrent')
+            torrent.save(saved)
+
+            info = Torrent(saved).info
+
+            self.assertEqual(info.pieces, expected)
+            self.assertEqual([f.path for f in info.files], [
+                ('data', 'file0'), ('data', 'file1'), ('data', 'file2'), ('data', 'sub', 'file3')
+            ])
+
+    def test_piece_length(self):
+        self.assertEqual(create.choose_piece_length(0), 2**14)
+        self.assertEqual(create.choose_piece_length(2**30), 2**20)
+        self.assertEqual(create.choose_piece_length(2**50), 2**24)
+
+def make_torrent(data, file_sizes, piece_length):
+    '''
+    Builds a multi-file torrent for `data` split into files of `file_sizes`.
+    '''
+
+    pieces = ''.join(hashlib.sha1(data[i:i + piece_length]).digest() for i in range(0, len(data), piece_length))
+
+    return Torrent({
+        'announce': 'http://localhost/announce',
+        'info': {
+            'name': 'data',
+            'piece length': piece_length,
+            'pieces': pieces,
+            'files': [{'path': ['file{0}'.format(i)], 'length': size} for i, size in enumerate(file_sizes)]
+        }
+    })
+
+class TestDiskStorage(unittest.TestCase):
+    storage_class = DiskStorage
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.data = os.urandom(10000)
+        self.torrent = make_torrent(self.data, [3000, 0, 1, 4500, 2499], 640)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_bad_allocation(self):
+        self.assertRaises(ValueError, self.storage_class.from_torrent, self.torrent, self.directory, allocation='bogus')
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_read_write(self):
+        storage = self.storage_class.from_torrent(self.torrent, self.directory)
+
+        self.assertFalse(storage.verify())
+
+        for index in range(storage.num_blocks):
+            block = self.data[640 * index:640 * (index + 1)]
+
+            storage.write_piece(index, 0, block[:100])
+            storage.write_piece(index, 100, block[100:])
+
+        self.assertTrue(storage.verify())
+        self.assertEqual(utils.as_bytes(storage.read_piece(4, 400, 240)), self.data[2960:3200])
+        self.assertEqual(utils.as_bytes(storage.read_piece(6, 0, 640)), self.data[3840:4480])
+        self.assertEqual(utils.as_bytes(storage.read_piece(15, 0, 400)), self.data[9600:])
+        self.assertRaises(ValueError, storage.read_piece, 15, 0, 640)
+
+        del storage
+
+        with open(os.path.join(self.directory, 'data', 'file3'), 'rb') as handle:
+            self.assertEqual(handle.read(), self.data[3001:7501])
+
+    def test_buffering(self):
+        data = os.urandom(4 * 2**15)
+        torrent = make_torrent(data, [2**16 + 5, 2**16 - 5], 2**15)
+        storage = self.storage_class.from_torrent(torrent, self.directory, buffer_size=2**16)
+        block = lambda index: data[2**14 * index:2**14 * (index + 1)]
+
+        # Out of order, nothing hits the disk until the piece is complete
+        self.assertFalse(storage.write_piece(0, 2**14, block(1)))
+        self.assertEqual(storage.buffered, 2**15)
+        self.assertEqual(storage.pending[0].hashed, 0)
+        self.assertFalse(storage.verify_block(0))
+
+        self.assertTrue(storage.write_piece(0, 0, block(0)))
+        self.assertTrue(storage.verify_block(0))
+        self.assertFalse(storage.write_piece(0, 0, block(0)))
+        self.assertEqual(storage.buffered, 0)
+
+        # A corrupt piece is thrown away
+        storage.write_piece(1, 0, block(2))
+        storage.write_piece(1, 2**14, '\x00' * 2**14)
+        self.assertFalse(storage.verify_block(1))
+        self.assertNotIn(1, storage.pending)
+
+        # Going over the buffer size spills the oldest partial piece
+        storage.write_piece(1, 0, block(2))
+        storage.write_piece(2, 0, block(4))
+        storage.write_piece(3, 0, block(6))
+        self.assertIsNone(storage.pending[1].buffer)
+        self.assertEqual(storage.pending[1].hashed, 2**14)
+        self.assertEqual(storage.buffered, 2**16)
+
+        for index in (1, 2, 3):
+            storage.write_piece(index, 2**14, block(2 * index + 1))
+
+        self.assertTrue(storage.verify())
+        self.assertEqual(storage.buffered, 0)
+
+    def test_piece_locks(self):
+        data = os.urandom(2 * 2**15)
+        storage = self.storage_class.from_torrent(make_torrent(data, [2**16], 2**15), self.directory, buffer_size=2**15)
+        storage.write_piece(0, 0, data[:2**14])
+
+        # A piece that is being worked on holds up neither other pieces nor
+        # spilling, which skips it
+        with storage.pending[0].lock:
+            thread = threading.Thread(target=storage.write_piece, args=(1, 0, data[2**15:]))
+            thread.start()
+            thread.join(5)
+
+            self.assertTrue(storage.blocks[1])
+            storage.spill(limit=0)
+            self.assertIsNotNone(storage.pending[0].buffer)
+
+        storage.flush()
+        self.assertIsNone(storage.pending[0].buffer)
+        self.assertEqual(storage.buffered, 0)
+
+        storage.write_piece(0, 2**14, data[2**14:2**15])
+        self.assertTrue(storage.verify())
+
+    def test_unaligned_writes(self):
+        data = os.urandom(2 * 2**15)
+        storage = self.storage_class.from_torrent(make_torrent(data, [2**16], 2**15), self.directory, buffer_size=2**15)
+
+        # Unaligned and overlapping writes still complete the piece
+        for start, stop in [(0, 2**13), (2**14 + 100, 2**15), (2**13 - 50, 2**14 + 200)]:
+            self.assertFalse(storage.blocks[0])
+            written = storage.write_piece(0, start, data[start:stop])
+
+        self.assertTrue(written)
+        self.assertTrue(storage.blocks[0])
+
+        # Partial blocks of a spilled piece make it to disk as well
+        storage.write_piece(1, 0, data[2**15:2**15 + 2**13])
+        storage.spill(limit=0)
+        self.assertIsNone(storage.pending[1].buffer)
+
+        storage.write_piece(1, 2**13, data[2**15 + 2**13:])
+        self.assertTrue(storage.verify())
+
+    def test_recheck(self):
+        storage = self.storage_class.from_torrent(self.torrent, self.directory, workers=3)
+
+        for index in range(0, storage.num_blocks, 2):
+            storage.write_piece(index, 0, self.data[640 * index:640 * (index + 1)])
+
+        storage.recheck_batch_size = 2000
+        storage.blocks.clear()
+        progress = []
+
+        self.assertFalse(storage.recheck(progress=lambda checked, total: progress.append((checked, total))))
+        self.assertEqual(list(storage.blocks), [index % 2 == 0 for index in range(storage.num_blocks)])
+        self.assertEqual(progress[-1], (16, 16))
+        self.assertEqual(len(progress), 6)
+
+        for index in range(1, storage.num_blocks, 2):
+            storage.write_piece(index, 0, self.data[640 * index:640 * (index + 1)])
+
+        storage.blocks[-1] = None
+        self.assertTrue(storage.verify())
+        self.assertEqual(storage.to_bitfield(), b'\xff\xff')
+
+    def test_resume(self):
+        storage = self.storage_class.from_torrent(self.torrent, self.directory)
+
+        for index in range(storage.num_blocks - 1):
+            storage.write_piece(index, 0, self.data[640 * index:640 * (index + 1)])
+
+        storage.close()
+        del storage
+
+        # Only verified blocks are trusted, the rest might never have been checked
+        storage = self.storage_class.from_torrent(self.torrent, self.directory)
+        self.assertEqual(list(storage.blocks), [True] * 15 + [None])
+        storage.close()
+        del storage
+
+        # file3 changed, so the blocks it touches have to be rechecked
+        path = os.path.join(self.directory, 'data', 'file3')
+        os.utime(path, (0, 0))
+
+        storage = self.storage_class.from_torrent(self.torrent, self.directory)
+        self.assertEqual(list(storage.blocks), [True] * 4 + [None] * 8 + [True] * 3 + [None])
+        self.assertFalse(storage.verify())
+        self.assertEqual(list(storage.blocks), [True] * 15 + [False])
+
+        storage.write_piece(15, 0, self.data[9600:])
+        storage.close()
+        del storage
+
+        # Complete data that was never verified stays unknown across restarts
+        os.remove(os.path.join(self.directory, 'data.resume'))
+        self.storage_class.from_torrent(self.torrent, self.directory).close()
+
+        storage = self.storage_class.from_torrent(self.torrent, self.directory)
+        self.assertEqual(storage.blocks.num_known, 0)
+        self.assertTrue(storage.verify())
+
+    def test_file_handles(self):
+        storage = self.storage_class.from_torrent(self.torrent, self.directory, max_open_files=2)
+        handles = storage.handles
+
+        self.assertEqual(handles.stats()['open'], 0)
+
+        for index in range(storage.num_blocks):
+            storage.write_piece(index, 0, self.data[640 * index:640 * (index + 1)])
+
+        self.assertTrue(storage.verify())
+        self.assertEqual(handles.stats()['open'], 2)
+        self.assertEqual(handles.evictions, handles.opens - 2)
+
+        # Completed files are reopened read-only, until something is written
+        handles.close()
+        file = storage.files[0]
+
+        handle = handles.acquire(file)
+        self.assertEqual(handle.mode, 'rb')
+
+        writable = handles.acquire(file, write=True)
+        self.assertEqual(writable.mode, 'r+b')
+        self.assertFalse(handle.closed)
+
+        handles.release(handle)
+        handles.release(writable)
+        self.assertTrue(handle.closed)
+        self.assertEqual(utils.as_bytes(storage.read_piece(0, 0, 640)), self.data[:640])
+
+    def test_priorities(self):
+        storage = self.storage_class.from_torrent(self.torrent, self.directory, priorities=[NORMAL, NORMAL, HIGH, SKIP, NORMAL])
+        path = os.path.join(self.directory, 'data', 'file3')
+
+        # Only the parts of file3 in blocks 4 and 11 are kept
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(os.path.getsize(path + '.part'), 199 + 461)
+        self.assertEqual(storage.wanted, [True] * 5 + [False] * 6 + [True] * 5)
+        self.assertEqual(storage.block_priorities[4], HIGH)
+
+        for index in range(storage.num_blocks):
+            completed = storage.write_piece(index, 0, self.data[640 * index:640 * (index + 1)])
+            self.assertEqual(completed, storage.wanted[index])
+
+        self.assertTrue(storage.verify())
+        self.assertEqual(storage.percentage(), 100)
+        self.assertEqual(storage.piece_chart(), '*****      *****')
+        self.assertEqual(utils.as_bytes(storage.read_piece(11, 0, 640)), self.data[7040:7680])
+
+        # Rechecking leaves the skipped blocks alone
+        storage.blocks.clear()
+        self.assertTrue(storage.recheck())
+        self.assertEqual(storage.piece_chart(), '*****      *****')
+
+        # Wanting the file again moves the shared blocks into it
+        storage.set_priority(3, NORMAL)
+
+        self.assertFalse(os.path.exists(path + '.part'))
+        self.assertFalse(storage.verify())
+
+        for index in range(5, 11):
+            storage.write_piece(index, 0, self.data[640 * index:640 * (index + 1)])
+
+        self.assertTrue(storage.verify())
+        storage.close()
+
+        with open(path, 'rb') as handle:
+            self.assertEqual(handle.read(), self.data[3001:7501])
+
+    def test_read_cache(self):
+        storage = ReadCache(self.storage_class.from_torrent(self.torrent, self.directory), size=1500)
+
+        for index in range(storage.num_blocks - 1):
+            storage.write_piece(index, 0, self.data[640 * index:640 * (index + 1)])
+
+        # Unverified pieces are not cached
+        self.assertEqual(utils.as_bytes(storage.read_piece(15, 0, 0)), b'')
+        self.assertEqual(storage.stats()['cached_pieces'], 0)
+
+        for offset in range(0, 640, 160):
+            self.assertEqual(storage.read_piece(4, offset, 160), self.data[2560 + offset:2720 + offset])
+
+        self.assertEqual((storage.hits, storage.misses), (3, 1))
+
+        storage.read_piece(5, 0, 10)
+        storage.read_piece(4, 0, 10)
+        storage.read_piece(6, 0, 10)
+
+        # Two pieces fit, so the least recently used one goes
+        self.assertEqual(list(storage.pieces), [4, 6])
+        self.assertEqual(storage.stats()['cached_bytes'], 1280)
+        self.assertEqual(storage.evictions, 1)
+        self.assertRaises(ValueError, storage.read_piece, 4, 600, 100)
+
+class TestBlockState(unittest.TestCase):
+    def test_counters(self):
+        state = BlockState(10)
+
+        self.assertEqual(list(state), [None] * 10)
+        self.assertEqual(state.to_bytes(), b'\x00\x00')
+
+        state[0] = True
+        state[9] = True
+        state[9] = True
+        state[3] = False
+
+        self.assertEqual((state.num_verified, state.num_known), (2, 3))
+        self.assertEqual(state.to_bytes(), b'\x80\x40')
+        self.assertEqual(state[-1], True)
+        self.assertRaises(IndexError, lambda: state[10])
+
+        state.set_wanted([True] * 5 + [False] * 5)
+        self.assertEqual((state.num_wanted, state.num_wanted_verified, state.num_wanted_known), (5, 1, 2))
+
+        for index in range(5):
+            state[index] = True
+
+        self.assertTrue(state.complete)
+
+        state[0] = None
+        self.assertFalse(state.complete)
+        self.assertEqual((state.num_verified, state.num_known, state.num_wanted_known), (5, 5, 4))
+
+        state.clear()
+        self.assertEqual((state.num_verified, state.num_known, state.num_wanted_verified), (0, 0, 0))
+
+class SmallWindowMmapStorage(MmapStorage):
+    window_size = mmap.ALLOCATIONGRANULARITY
+
+class TestMmapStorage(TestDiskStorage):
+    storage_class = SmallWindowMmapStorage
+
+class TestMemoryStorage(unittest.TestCase):
+    def setUp(self):
+        self.data = os.urandom(10000)
+        self.torrent = make_torrent(self.data, [3000, 0, 1, 4500, 2499], 640)
+
+    def test_seed_and_leech(self):
+        seeder = MemoryStorage.from_torrent(self.torrent, data=self.data)
+        leecher = MemoryStorage.from_torrent(self.torrent)
+
+        self.assertEqual(seeder.to_bitfield(), b'\xff\xff')
+        self.assertFalse(leecher.verify())
+
+        for index in range(seeder.num_blocks):
+            leecher.write_piece(index, 0, seeder.read_block(index))
+
+        self.assertTrue(leecher.verify())
+        self.assertEqual(bytes(leecher.data), self.data)
+        self.assertRaises(ValueError, MemoryStorage.from_torrent, self.torrent, data=self.data[1:])
+
+    def test_recheck_skipped(self):
+        storage = MemoryStorage.from_torrent(self.torrent, data=self.data, priorities=[NORMAL, NORMAL, NORMAL, SKIP, NORMAL])
+
+        self.assertTrue(storage.recheck())
+        self.assertEqual(list(storage.blocks), [True] * 5 + [None] * 6 + [True] * 5)
+
+    def test_server(self):
+        server = Server(self.torrent, storage_class=MemoryStorage, storage_options={'data': self.data})
+
+        self.assertIsInstance(server.storage.storage, MemoryStorage)
+        self.assertEqual(server.storage.percentage(), 0)
+        self.assertTrue(server.storage.verify())
+
+        server.async_storage.close()
+
+class TestAsyncStorage(AsyncTestCase):
+    def setUp(self):
+        super(TestAsyncStorage, self).setUp()
+
+        self.directory = tempfile.mkdtemp()
+        self.data = os.urandom(4 * 2**15)
+        self.torrent = make_torrent(self.data, [2**16 + 5, 2**16 - 5], 2**15)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(TestAsyncStorage, self).tearDown()
+
+    @gen_test
+    def test_read_write(self):
+        storage = AsyncStorage(DiskStorage.from_torrent(self.torrent, self.directory), workers=3, io_loop=self.io_loop)
+        block = lambda index: self.data[2**14 * index:2**14 * (index + 1)]
+
+        writes = [storage.write_piece(index // 2, 2**14 * (index % 2), block(index)) for index in range(8)]
+        reads = [storage.read_piece(index, 0, 2**15) for index in range(4)]
+
+        completed = yield writes
+        data = yield reads
+
+        self.assertEqual(completed, [False, True] * 4)
+        self.assertEqual(''.join(data), self.data)
+        self.assertTrue((yield storage.verify_block(3, force=True)))
+
+        with self.assertRaises(ValueError):
+            yield storage.read_piece(0, 2**15, 1)
+
+        stats = storage.stats()
+        self.assertEqual((stats['completed'], stats['in_flight']), (14, 0))
+
+        storage.close()
+
 class TestProtocolMessages(unittest.TestCase):
     def test_keep_alive(self):
         self.assertIsInstance(KeepAlive.unpack(''), KeepAlive)
@@ -26,27 +537,449 @@ class TestProtocolMessages(unittest.TestCase):
         self.assertRaises(struct.error, Have(piece=12345678910).pack)
 
     def test_bitfield(self):
-        b = {
-            0: True,
-            1: False,
-            3: True
-        }
+        bitfield = Bitfield.from_pieces([0, 3, 9], count=10)
+        unpacked = Bitfield.unpack(bitfield.pack(with_header=True), with_header=True)
 
-        c = {
-            0: True,
-            1: False,
-            2: False,
-            3: True,
-            4: False,
-            5: False,
-            6: False,
-            7: False
-        }
+        self.assertEqual(unpacked.pack_body(), b'\x90\x40')
+        self.assertEqual(list(unpacked), [0, 3, 9])
+        self.assertEqual(unpacked.popcount(), 3)
+        self.assertTrue(unpacked.has(9))
+        self.assertFalse(unpacked.has(1))
+        self.assertFalse(unpacked.has(100))
+
+        # Leading zero bits of a byte count too
+        self.assertEqual(list(Bitfield(b'\x01\x20')), [7, 10])
+        self.assertFalse(Bitfield(b'\x00\x00'))
+
+        # Spare bits are cleared
+        self.assertEqual(Bitfield(b'\xff\xff', count=10).pack_body(), b'\xff\xc0')
+        self.assertEqual(Bitfield(b'\xff', count=10).pack_body(), b'\xff\x00')
+
+        ours = b'\x80\x00'
+        self.assertEqual(list(unpacked.difference(ours)), [3, 9])
+        self.assertEqual(list(unpacked.intersection(b'\x10')), [3])
+        self.assertEqual(list(unpacked.union(Bitfield(b'\x01'))), [0, 3, 7, 9])
+
+class TestFramer(unittest.TestCase):
+    def test_feed(self):
+        block = os.urandom(2**14)
+        messages = [Have(3), KeepAlive(), Piece(1, 2**14, block), Bitfield(b'\xf0'), Choke()]
+        data = b''.join(message.pack() for message in messages)
+
+        for chunk_size in (1, 3, 5, 1000, len(data)):
+            framer = Framer()
+            received = []
+
+            for index in range(0, len(data), chunk_size):
+                received.extend(framer.feed(data[index:index + chunk_size]))
+
+            self.assertEqual([id for id, body in received], [Have.id, None, Piece.id, Bitfield.id, Choke.id])
+            self.assertEqual(Have.unpack(received[0][1]).piece, 3)
+            self.assertEqual(Bitfield.unpack(received[3][1]).pack_body(), b'\xf0')
+
+            piece = Piece.unpack(received[2][1])
+            self.assertIsInstance(piece.block, memoryview)
+            self.assertEqual((piece.index, piece.begin, piece.block.tobytes()), (1, 2**14, block))
+
+        self.assertRaises(ValueError, Framer(max_length=100).feed, Piece(0, 0, b'x' * 100).pack())
+
+        # Bitfields of huge torrents are longer than any Piece
+        bitfield = Bitfield(count=2**23)
+        self.assertEqual(len(Framer(max_message_length(2**23)).feed(bitfield.pack())), 1)
+        self.assertRaises(struct.error, Have.unpack, memoryview(b'\x00\x01'))
+
+class TestMessageWriter(AsyncTestCase):
+    @gen_test
+    def test_coalescing(self):
+        left, right = socket.socketpair()
+        sender, receiver = IOStream(left), IOStream(right)
+        writer = MessageWriter(sender, flush_size=100, io_loop=self.io_loop)
+
+        messages = [Have(index) for index in range(3)]
+
+        for message in messages:
+            writer.send(message)
+
+        # Nothing is written until the IOLoop comes around
+        self.assertEqual(writer.flushes, 0)
+        data = yield receiver.read_bytes(27)
+        self.assertEqual(data, b''.join(message.pack() for message in messages))
+        self.assertEqual(writer.stats(), {'messages': 3, 'flushes': 1, 'bytes': 27, 'sendfile_bytes': 0})
+
+        # Past the flush size, it is written right away
+        writer.send(Piece(0, 0, b'x' * 100))
+        self.assertEqual(writer.flushes, 2)
+
+        # Messages can be taken back until they are written
+        writer.send(Have(5), key=5)
+        writer.send(Have(6), key=6)
+        self.assertTrue(writer.cancel(5))
+        self.assertFalse(writer.cancel(5))
+
+        data = yield receiver.read_bytes(113 + 9)
+        self.assertEqual(data[113:], Have(6).pack())
+        self.assertFalse(writer.cancel(6))
+
+        sender.close()
+        receiver.close()
+
+    @gen_test
+    def test_send_file(self):
+        directory = tempfile.mkdtemp()
+        data = os.urandom(10000)
+        storage = DiskStorage.from_torrent(make_torrent(data, [3000, 7000], 640), directory)
+
+        for index in range(storage.num_blocks):
+            storage.write_piece(index, 0, data[640 * index:640 * (index + 1)])
+
+        left, right = socket.socketpair()
+        sender, receiver = IOStream(left), IOStream(right)
+        writer = MessageWriter(sender, io_loop=self.io_loop)
+
+        # Block 4 spans both files
+        self.assertIsNone(storage.locate_piece(4, 0, 640))
+        file, offset = storage.locate_piece(5, 100, 500)
+        header = Piece.pack_header(5, 100, 500)
+        expected = Have(1).pack() + Piece(5, 100, data[3300:3800]).pack() + Have(2).pack()
+
+        writer.send(Have(1))
+
+        if writer.hold():
+            # Messages sent in the meantime wait for the Piece
+            writer.send(Have(2))
+            self.assertFalse(writer.hold())
+
+            written, sent, rest = writer_module.transfer(left.fileno(), header, file, offset, 500)
+            writer.finish_file(written, sent, rest)
+
+            self.assertEqual((written, sent, rest), (len(header) + 500, 500, b''))
+        else:
+            self.assertIsNone(writer_module.sendfile)
+            writer.send(Piece(5, 100, data[3300:3800]))
+            writer.send(Have(2))
+
+        self.assertEqual((yield receiver.read_bytes(len(expected))), expected)
+
+        # The socket takes part of the block, the rest is read instead
+        calls = []
+
+        def partial_sendfile(out, in_fd, position, count):
+            calls.append(position)
+
+            if len(calls) > 1:
+                raise OSError(errno.EAGAIN, 'Try again')
+
+            return os.write(out, data[3000 + position:3000 + position + 100])
+
+        original, writer_module.sendfile = writer_module.sendfile, partial_sendfile
+
+        try:
+            self.assertTrue(writer.hold())
+            written, sent, rest = writer_module.transfer(left.fileno(), header, file, offset, 500)
+        finally:
+            writer_module.sendfile = original
+
+        self.assertEqual((written, sent, rest), (len(header) + 100, 100, data[3400:3800]))
+        writer.finish_file(written, sent, rest)
+
+        expected = Piece(5, 100, data[3300:3800]).pack()
+        self.assertEqual((yield receiver.read_bytes(len(expected))), expected)
+
+        sender.close()
+        receiver.close()
+        storage.close()
+        shutil.rmtree(directory)
+
+    @gen_test
+    def test_upload(self):
+        directory = tempfile.mkdtemp()
+        data = os.urandom(10000)
+        server = Server(make_torrent(data, [3000, 7000], 640), download_path=directory, read_cache_size=0)
+
+        for index in range(server.storage.num_blocks):
+            server.storage.write_piece(index, 0, data[640 * index:640 * (index + 1)])
+
+        left, right = socket.socketpair()
+        receiver = IOStream(right)
+        receive = receiver_for(receiver)
+        client = Client(IOStream(left), Peer('1.2.3.4', 1), server)
+
+        # One block is sent with sendfile, the other spans both files
+        for index in (5, 4):
+            client.dispatch(Request.id, Request(index, 0, 640).pack_body())
+
+        messages = yield receive(2)
+        self.assertEqual([(m.index, m.block.tobytes()) for m in messages], [(5, data[3200:3840]), (4, data[2560:3200])])
+        self.assertEqual(client.writer.sendfile_bytes, 640 if writer_module.sendfile is not None else 0)
+
+        client.keepalive_callback.stop()
+        client.stream.close()
+        receiver.close()
+        server.async_storage.close()
+        server.storage.close()
+        shutil.rmtree(directory)
+
+    def test_have_suppression(self):
+        data = os.urandom(10000)
+        server = Server(make_torrent(data, [10000], 640), storage_class=MemoryStorage, read_cache_size=0)
+        received = {}
+
+        class FakeClient(object):
+            def __init__(self, name, pieces):
+                self.peer_choking = False
+                self.peer_blocks = Bitfield.from_pieces(pieces, 16)
+                received[name] = []
+                self.send_message = received[name].append
+
+        server.connected_peers.update([FakeClient('seed', range(16)), FakeClient('leech', [1])])
+        server.announce_message(Have(3))
+        server.announce_message(Have(1))
+
+        self.assertEqual(received['seed'], [])
+        self.assertEqual([message.piece for message in received['leech']], [3])
+
+        server.async_storage.close()
+
+class TestFastExtension(AsyncTestCase):
+    def test_messages(self):
+        self.assertIsInstance(HaveAll.unpack(HaveAll().pack(), with_header=True), HaveAll)
+        self.assertIsInstance(HaveNone.unpack(HaveNone().pack(), with_header=True), HaveNone)
+        self.assertEqual(Suggest.unpack(Suggest(7).pack(), with_header=True).piece, 7)
+        self.assertEqual(AllowedFast.unpack(AllowedFast(9).pack(), with_header=True).piece, 9)
+
+        reject = Reject.unpack(Reject(1, 2**14, 2**14).pack(), with_header=True)
+        self.assertEqual((reject.index, reject.begin, reject.length), (1, 2**14, 2**14))
+
+    def test_allowed_fast_set(self):
+        # Example from BEP 6
+        self.assertEqual(allowed_fast_set('80.4.4.200', b'\xaa' * 20, 1313, k=7), [1059, 431, 808, 1217, 287, 376, 1188])
+        self.assertEqual(allowed_fast_set('80.4.4.200', b'\xaa' * 20, 1313, k=9), [1059, 431, 808, 1217, 287, 376, 1188, 353, 508])
+
+        self.assertEqual(sorted(allowed_fast_set('80.4.4.1', b'\xaa' * 20, 5)), [0, 1, 2, 3, 4])
+        self.assertEqual(allowed_fast_set('::1', b'\xaa' * 20, 1313), [])
 
-        self.assertEqual(
-            Bitfield.unpack(Bitfield(b).pack(with_header=True), with_header=True).bitfield,
-            c
-        )
+    @gen_test
+    def test_client(self):
+        data = os.urandom(10000)
+        server = Server(make_torrent(data, [10000], 640), storage_class=MemoryStorage, read_cache_size=0)
+        left, right = socket.socketpair()
+        receiver = IOStream(right)
+
+        client = Client(IOStream(left), Peer('1.2.3.4', 1), server)
+        client.fast = True
+        receive = receiver_for(receiver)
+
+        # Choked, but allowed to fetch piece 3
+        client.dispatch(HaveAll.id, b'')
+        client.dispatch(AllowedFast.id, AllowedFast(3).pack_body())
+
+        messages = yield receive(2)
+        self.assertIsInstance(messages[0], Interested)
+        self.assertEqual((messages[1].index, messages[1].begin, messages[1].length), (3, 0, 640))
+
+        # Requests for missing pieces are rejected
+        client.dispatch(Request.id, Request(5, 0, 640).pack_body())
+        messages = yield receive(1)
+        self.assertEqual((messages[0].id, messages[0].index), (Reject.id, 5))
+
+        # So are invalid ones
+        with ExpectLog('', 'Block index out of range'):
+            client.dispatch(Request.id, Request(100, 0, 640).pack_body())
+            messages = yield receive(1)
+
+        self.assertEqual((messages[0].id, messages[0].index), (Reject.id, 100))
+
+        client.dispatch(HaveNone.id, b'')
+        self.assertFalse(client.peer_blocks)
+
+        client.keepalive_callback.stop()
+        client.stream.close()
+        receiver.close()
+        server.async_storage.close()
+
+    @gen_test
+    def test_seeder_have_all(self):
+        data = os.urandom(10000)
+        server = Server(make_torrent(data, [10000], 640), storage_class=MemoryStorage, storage_options={'data': data}, read_cache_size=0)
+        left, right = socket.socketpair()
+        receiver = IOStream(right)
+
+        client = Client(IOStream(left), Peer('1.2.3.4', 1), server)
+        client.fast = True
+        receive = receiver_for(receiver)
+
+        # Nothing has verified the prefilled data before the handshake
+        self.assertFalse(server.storage.blocks.num_verified)
+        client.message_loop()
+
+        messages = yield receive(1)
+        self.assertIsInstance(messages[0], HaveAll)
+        self.assertTrue(server.storage.blocks.complete)
+
+        client.keepalive_callback.stop()
+        client.stream.close()
+        receiver.close()
+        server.async_storage.close()
+
+    @gen_test
+    def test_unsupported(self):
+        server = Server(make_torrent(os.urandom(10000), [10000], 640), storage_class=MemoryStorage, read_cache_size=0)
+        left, right = socket.socketpair()
+        client = Client(IOStream(left), Peer('1.2.3.4', 1), server)
+
+        # Fast Extension messages from a peer that didn't announce it
+        with ExpectLog('', '.* without supporting the Fast Extension'):
+            client.dispatch(HaveAll.id, b'')
+
+        self.assertTrue(client.stream.closed())
+        self.assertFalse(client.peer_blocks)
+
+        client.keepalive_callback.stop()
+        IOStream(right).close()
+        server.async_storage.close()
+
+class TestClient(AsyncTestCase):
+    @gen_test
+    def test_handler_errors(self):
+        data = os.urandom(10000)
+        server = Server(make_torrent(data, [10000], 640), storage_class=MemoryStorage, read_cache_size=0)
+        left, right = socket.socketpair()
+        client = Client(IOStream(left), Peer('1.2.3.4', 1), server)
+
+        # The write fails in a storage thread, after got_piece has returned
+        with ExpectLog('', 'Cannot write across blocks') as log:
+            client.dispatch(Piece.id, Piece(0, 600, b'x' * 100).pack_body())
+
+            while not log.matched:
+                yield sleep(0.01)
+
+        client.keepalive_callback.stop()
+        client.stream.close()
+        IOStream(right).close()
+        server.async_storage.close()
+
+    @gen_test
+    def test_cancel(self):
+        data = os.urandom(10000)
+        server = Server(make_torrent(data, [10000], 640), storage_class=MemoryStorage, storage_options={'data': data}, read_cache_size=0)
+        left, right = socket.socketpair()
+        receiver = IOStream(right)
+        receive = receiver_for(receiver)
+        client = Client(IOStream(left), Peer('1.2.3.4', 1), server)
+        self.assertTrue(server.storage.verify())
+
+        # The first request is cancelled while its data is being read
+        client.dispatch(Request.id, Request(1, 0, 640).pack_body())
+        client.dispatch(Cancel.id, Cancel(1, 0, 640).pack_body())
+        client.dispatch(Request.id, Request(2, 0, 640).pack_body())
+
+        messages = yield receive(1)
+        self.assertEqual((messages[0].index, messages[0].block.tobytes()), (2, data[1280:1920]))
+        self.assertEqual(client.uploads, set())
+        self.assertEqual(client.writer.messages, 1)
+
+        client.keepalive_callback.stop()
+        client.stream.close()
+        receiver.close()
+        server.async_storage.close()
+
+    @gen_test
+    def test_framing_errors(self):
+        server = Server(make_torrent(os.urandom(10000), [10000], 640), storage_class=MemoryStorage, read_cache_size=0)
+        left, right = socket.socketpair()
+        receiver = IOStream(right)
+        client = Client(IOStream(left), Peer('1.2.3.4', 1), server)
+
+        with ExpectLog('', 'Dropping .*: Message is too long'):
+            loop = client.message_loop()
+            yield receiver.write(struct.pack('!I', 2**30))
+            yield loop
+
+        self.assertTrue(client.stream.closed())
+
+        receiver.close()
+        server.async_storage.close()
+
+class TestPipelining(AsyncTestCase):
+    @gen_test
+    def test_request_window(self):
+        data = os.urandom(100000)
+        server = Server(make_torrent(data, [100000], 2**15), storage_class=MemoryStorage, read_cache_size=0, max_requests=5)
+        left, right = socket.socketpair()
+        receiver = IOStream(right)
+        receive = receiver_for(receiver)
+
+        client = Client(IOStream(left), Peer('1.2.3.4', 1), server)
+        client.dispatch(Bitfield.id, b'\xf0')
+        client.dispatch(Unchoke.id, b'')
+
+        messages = yield receive(6)
+        self.assertIsInstance(messages[0], Interested)
+
+        requests = [(m.index, m.begin, m.length) for m in messages[1:]]
+        self.assertEqual(len(set(requests)), 5)
+        self.assertEqual(client.requests, set(requests))
+
+        # Every answered request is replaced by a new one
+        index, begin, length = requests[0]
+        client.dispatch(Piece.id, Piece(index, begin, data[index * 2**15 + begin:][:length]).pack_body())
+
+        messages = yield receive(1)
+        request = (messages[0].index, messages[0].begin, messages[0].length)
+        self.assertNotIn(request, requests)
+        self.assertEqual(len(client.requests), 5)
+
+        # The last piece is shorter than a request
+        self.assertTrue(all(length == (1696 if index == 3 else 2**14) for index, begin, length in client.requests | {request}))
+
+        # The peer forgets our requests when it chokes us
+        client.dispatch(Choke.id, b'')
+        self.assertEqual((client.requests, list(client.request_queue), client.pieces_left), (set(), [], {}))
+
+        client.dispatch(Unchoke.id, b'')
+        messages = yield receive(5)
+        self.assertEqual(len(client.requests), 5)
+
+        client.keepalive_callback.stop()
+        client.stream.close()
+        receiver.close()
+        server.async_storage.close()
+
+    @gen_test
+    def test_no_rerequest_while_writing(self):
+        data = os.urandom(2**16)
+        server = Server(make_torrent(data, [2**16], 2**15), storage_class=MemoryStorage, read_cache_size=0, max_requests=5)
+        left, right = socket.socketpair()
+        receiver = IOStream(right)
+        receive = receiver_for(receiver)
+
+        client = Client(IOStream(left), Peer('1.2.3.4', 1), server)
+        client.dispatch(Bitfield.id, b'\xc0')
+        client.dispatch(Unchoke.id, b'')
+
+        messages = yield receive(5)
+        sent = client.writer.messages
+
+        # Holding the lock keeps the storage threads from finishing the writes
+        with server.storage.lock:
+            for begin in (0, 2**14):
+                client.dispatch(Piece.id, Piece(0, begin, data[begin:begin + 2**14]).pack_body())
+
+            # Nothing new is requested while piece 0 is being written and checked
+            self.assertEqual(client.writer.messages, sent)
+            self.assertEqual(client.pieces_left.get(0), 0)
+
+        while 0 in client.pieces_left:
+            yield sleep(0.01)
+
+        self.assertTrue(server.storage.blocks[0])
+        self.assertEqual(client.writer.messages, sent)
+        self.assertEqual(set(request[0] for request in client.requests), set([1]))
+
+        client.keepalive_callback.stop()
+        client.stream.close()
+        receiver.close()
+        server.async_storage.close()
 
 class TestTracker(AsyncTestCase):
     def test_autodetect(self):
@@ -90,6 +1023,27 @@ class TestUtils(unittest.TestCase):
         utils.fill(handle, 1024)
         self.assertEquals(handle.content, '\x00' * 1024)
 
+    def test_allocate(self):
+        directory = tempfile.mkdtemp()
+
+        try:
+            for strategy in ('sparse', 'full', 'zero'):
+                path = os.path.join(directory, strategy)
+                utils.create_and_open(path, 'r+b', size=2**20 + 1, allocation=strategy).close()
+
+                self.assertEqual(os.path.getsize(path), 2**20 + 1)
+
+                with open(path, 'rb') as handle:
+                    self.assertEqual(handle.read(), '\x00' * (2**20 + 1))
+
+            self.assertRaises(ValueError, utils.allocate, None, 10, 'magic')
+
+            path = os.path.join(directory, 'magic')
+            self.assertRaises(ValueError, utils.create_and_open, path, 'r+b', size=100, allocation='magic')
+            self.assertFalse(os.path.exists(path))
+        finally:
+            shutil.rmtree(directory)
+
 
 if __name__ == '__main__':
     unittest.main()